@@ -1,5 +1,11 @@
 import logging
+from collections.abc import AsyncIterable
+import numpy
+import pandas
 from pandas import DataFrame
+from .energy_state import EnergyAccumulator
+from .kernels import trapezoid_by_group
+from query.influx import Interval
 
 logger = logging.getLogger(__name__)
 
@@ -12,70 +18,207 @@ def calculate_power(config):
     machine_power_factors = config["power_factor"].get("machines", {})
 
     async def wrapped(data_frame: DataFrame):
+        # only None (not NaN) counts as a missing power value, a column that isn't there at all is missing throughout
+        codes, machines = pandas.factorize(data_frame["machine"])
 
-        # logger.info(data_frame.to_string())
-        for index,row in data_frame.iterrows():
-            if "power_apparent" in row and "power_real" in row:
-                data_frame.drop(index)  # values already there - no need to calculate
-
-            machine = row["machine"]
-            if "power_apparent" not in row or row["power_apparent"] is None:
-                voltage = (
-                    row["voltage"]
-                    if "voltage" in row
-                    else machine_voltages.get(machine, default_voltage)
-                )
-                power_apparent = (
-                    row["current"] * voltage if row["current"] is not None else None
-                )
-                data_frame.at[index, "power_apparent"] = power_apparent
+        if "power_apparent" in data_frame:
+            power_apparent = data_frame["power_apparent"]
+            calculate = _is_none(power_apparent)
+        else:
+            power_apparent = None
+            calculate = numpy.ones(len(data_frame), dtype=bool)
+
+        if calculate.any():
+            if "voltage" in data_frame:
+                voltage = data_frame["voltage"].to_numpy()
+            else:
+                voltage = _per_machine(codes, machines, machine_voltages, default_voltage)
+            current = data_frame["current"]
+            calculated = numpy.where(
+                _is_none(current), numpy.nan, _as_float(current) * _as_float(voltage)
+            )
+            if power_apparent is None:
+                data_frame["power_apparent"] = calculated
             else:
-                power_apparent = row["power_apparent"]
+                data_frame.loc[calculate, "power_apparent"] = calculated[calculate]
+            power_apparent = data_frame["power_apparent"]
 
-            if "power_real" not in row or row["power_real"] is None:
-                power_factor = machine_power_factors.get(machine, default_power_factor)
+        if "power_real" in data_frame:
+            calculate = _is_none(data_frame["power_real"])
+        else:
+            calculate = numpy.ones(len(data_frame), dtype=bool)
+
+        if calculate.any():
+            power_factor = _per_machine(codes, machines, machine_power_factors, default_power_factor)
+            calculated = numpy.where(
+                _is_none(power_apparent), numpy.nan, _as_float(power_apparent) * power_factor
+            )
+            if "power_real" in data_frame:
+                data_frame.loc[calculate, "power_real"] = calculated[calculate]
+            else:
+                data_frame["power_real"] = calculated
 
-                data_frame.at[index, "power_real"] = (
-                    power_apparent * power_factor
-                    if power_apparent is not None
-                    else None
-                )
-        # logger.info(data_frame.to_string())
         return data_frame
 
     return wrapped
 
 
-from scipy import integrate
-def calculate_energy(config):
+def _per_machine(codes, machines, table, default):
+    # look each distinct machine up once, then spread over the rows (code -1 is a missing machine)
+    values = numpy.array([table.get(machine, default) for machine in machines] + [default], dtype=float)
+    return values[codes]
+
+
+def _is_none(values):
+    values = numpy.asarray(values)
+    if values.dtype != object:
+        return numpy.zeros(len(values), dtype=bool)
+    return numpy.equal(values, None)
+
+
+def _as_float(values):
+    values = numpy.asarray(values)
+    if values.dtype == object:
+        values = numpy.where(numpy.equal(values, None), numpy.nan, values)
+    return values.astype(float)
+
+
+def calculate_energy(config, max_gap=None):
+    """data_frame may also be an async iterator of DataFrame chunks (see query.influx.do_stream_query),
+    consecutive chunks are integrated across their boundary so the result matches the whole frame.
+
+    max_gap (seconds or an interval string e.g. "5m", defaults to the energy_max_gap config setting)
+    leaves intervals between samples further apart than that out of the integral, so an outage
+    isn't counted as a straight line between the samples either side. Intervals next to a NaN
+    sample are always left out."""
+    max_gap = gap_seconds(max_gap if max_gap is not None else config.get("energy_max_gap"))
 
     async def wrapped(data_frame: DataFrame):
-        result = []
+        if isinstance(data_frame, AsyncIterable):
+            return await _calculate_energy_stream(data_frame, max_gap)
+
         if len(data_frame)>0:
-            for group_keys, df in data_frame.groupby(["machine"]):
-                # logger.info(f"{group_keys},{df}")
-                if "power_real" in df:
-                    df["_time_seconds"] = df["_time"].astype("int64") // 10**9
-                    # df["_time_seconds"] = df["_time"].timestamp()
-                    power_integral = integrate.trapezoid(
-                        df["power_real"], x=df["_time_seconds"]
-                    )
-                else:
-                    logger.warning("this shouldn't happen")
-                    # power_integral = integrate.trapezoid(df["current"], x=df["_time"])
-
-                energy_wh = power_integral/3600 # seconds in hour
-                result.append(
-                    {
-                        "machine": group_keys[0],
-                        "energy": energy_wh,
-                        "_time": df["_time"].iat[-1],
-                    }
-                )
-            output_df = DataFrame(result)
+            if "power_real" not in data_frame:
+                raise Exception("No power_real in dataframe")
+            time_seconds = data_frame["_time"].astype("int64").to_numpy() // 10**9
+            integrals = trapezoid_by_group(
+                data_frame["machine"], time_seconds, data_frame["power_real"], max_gap=max_gap
+            )
+            output_df = DataFrame(
+                {
+                    "machine": integrals.index,
+                    "energy": integrals["integral"].to_numpy() / 3600,  # seconds in hour
+                    "_time": data_frame["_time"].iloc[integrals["last_row"]].to_numpy(),
+                }
+            )
             # logger.info(output_df)
             return output_df
         else:
             raise Exception("No data in dataframe")
 
     return wrapped
+
+
+def gap_seconds(max_gap):
+    if max_gap is None:
+        return None
+    if isinstance(max_gap, str):
+        return Interval(max_gap).timedelta.total_seconds()
+    return float(max_gap)
+
+
+def energy_accumulator(config, name="energy") -> EnergyAccumulator:
+    return EnergyAccumulator.get_inst(
+        config.get("energy_state_path", "/app/data/energy_state.json"), name
+    )
+
+
+def accumulate_energy(config, name="energy", max_gap=None):
+    """Incremental alternative to calculate_energy for scheduled runs.
+
+    Integrates power_real since each machine's last run (see EnergyAccumulator), so only
+    new data needs querying, e.g.
+    ``real_power(config, energy_accumulator(config).query_from(dt_from), dt_to)``.
+    Outputs machine, energy (Wh since the last run), energy_total and _time (last sample)
+    for each machine that had new samples - an empty frame if none did.
+    data_frame may also be an async iterator of DataFrame chunks. max_gap is as for calculate_energy.
+    """
+    max_gap = gap_seconds(max_gap if max_gap is not None else config.get("energy_max_gap"))
+
+    async def wrapped(data_frame):
+        accumulator = energy_accumulator(config, name)
+        chunks = data_frame if isinstance(data_frame, AsyncIterable) else _single(data_frame)
+
+        increments = {}
+        async for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            if "power_real" not in chunk:
+                logger.warning("this shouldn't happen")
+                continue
+            for machine, increment in accumulator.update(chunk, max_gap=max_gap).items():
+                increments[machine] = increments.get(machine, 0.0) + increment
+        accumulator.save()
+
+        return DataFrame(
+            [
+                {
+                    "machine": machine,
+                    "energy": increment,
+                    "energy_total": accumulator.machines[machine]["total"],
+                    "_time": pandas.Timestamp(accumulator.machines[machine]["last_time_ns"], tz="UTC"),
+                }
+                for machine, increment in increments.items()
+            ],
+            columns=["machine", "energy", "energy_total", "_time"],
+        )
+
+    return wrapped
+
+
+async def _single(data_frame):
+    yield data_frame
+
+
+async def _calculate_energy_stream(chunks, max_gap=None):
+    # per machine running integral plus the last sample, which is carried into the next chunk
+    state = DataFrame(columns=["integral", "time_seconds", "power", "_time"])
+    async for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if "power_real" not in chunk:
+            logger.warning("this shouldn't happen")
+            continue
+        machines = numpy.concatenate([state.index.to_numpy(dtype=object), chunk["machine"].to_numpy(dtype=object)])
+        time_seconds = numpy.concatenate(
+            [state["time_seconds"].to_numpy(dtype="int64"), chunk["_time"].astype("int64").to_numpy() // 10**9]
+        )
+        power = numpy.concatenate([state["power"].to_numpy(dtype=float), chunk["power_real"].to_numpy(dtype=float)])
+        if len(state) == 0:  # concat with the empty object column is deprecated
+            times = chunk["_time"].reset_index(drop=True)
+        else:
+            times = pandas.concat([state["_time"], chunk["_time"]], ignore_index=True)
+
+        integrals = trapezoid_by_group(machines, time_seconds, power, max_gap=max_gap)
+        last = integrals["last_row"].to_numpy()
+        state = DataFrame(
+            {
+                "integral": integrals["integral"].to_numpy()
+                + state["integral"].reindex(integrals.index, fill_value=0.0).to_numpy(dtype=float),
+                "time_seconds": time_seconds[last],
+                "power": power[last],
+                "_time": times.iloc[last].to_numpy(),
+            },
+            index=integrals.index,
+        )
+
+    if len(state) == 0:
+        raise Exception("No data in dataframe")
+
+    return DataFrame(
+        {
+            "machine": state.index,
+            "energy": state["integral"].to_numpy(dtype=float) / 3600,  # seconds in hour
+            "_time": state["_time"].to_numpy(),
+        }
+    )
@@ -0,0 +1,141 @@
+import datetime
+import json
+import logging
+import os
+import numpy
+import pandas
+from .kernels import trapezoid_by_group
+
+logger = logging.getLogger(__name__)
+
+
+class EnergyAccumulator:
+    """Running per-machine energy totals, persisted to a JSON file so they survive restarts.
+
+    For each machine the last integrated sample (time and power) is kept as a watermark.
+    Each ``update`` integrates only samples after it, starting from the last sample of the
+    previous update, so the interval between two scheduled runs is counted exactly once.
+    Several accumulators (``name``) can share the file.
+    """
+
+    inst = {}
+
+    @classmethod
+    def get_inst(cls, path, name="energy") -> "EnergyAccumulator":
+        if cls.inst.get((path, name)) is None:
+            cls.inst[(path, name)] = cls(path, name)
+        return cls.inst[(path, name)]
+
+    def __init__(self, path, name="energy"):
+        self.path = path
+        self.name = name
+        self.machines = {}
+        self.load()
+
+    def query_from(self, default):
+        """Start for the next query - the earliest watermark, but never before ``default`` (which
+        is also used if nothing has been integrated yet).
+
+        A machine that has never been seen is only integrated from this point on. A machine
+        whose watermark is before ``default`` (e.g. it stopped reporting) doesn't hold the
+        query back, if it comes back the interval since its watermark is integrated
+        unless it is longer than max_gap."""
+        if not self.machines:
+            return default
+        earliest = pandas.Timestamp(min(state["last_time_ns"] for state in self.machines.values()), tz="UTC")
+        if isinstance(default, datetime.timedelta):  # relative to now, as for a query's range
+            floor = pandas.Timestamp.now(tz="UTC") + default
+        else:
+            floor = pandas.Timestamp(default)
+        if floor.tzinfo is None:
+            floor = floor.tz_localize("UTC")
+        if earliest < floor:
+            return default
+        return earliest.to_pydatetime()
+
+    def update(self, data_frame, max_gap=None):
+        """Integrate new samples (``machine``, ``_time``, ``power_real``), returns {machine: Wh added}.
+
+        Samples at or before a machine's watermark are ignored, so overlapping queries are safe.
+        As in calculate_energy (trapezoid_by_group), intervals next to a NaN sample and
+        intervals longer than ``max_gap`` seconds (e.g. the device was off line) aren't
+        integrated, so the running total matches calculate_energy over the same samples
+        however they are split between updates. A NaN sample still moves the watermark.
+        """
+        machines = data_frame["machine"].to_numpy(dtype=object)
+        times = data_frame["_time"].astype("int64").to_numpy()
+        power = data_frame["power_real"].to_numpy(dtype=float)
+
+        # each distinct machine's watermark looked up once (code -1 is a missing machine)
+        codes, distinct = pandas.factorize(machines)
+        earliest = numpy.iinfo("int64").min
+        watermarks = numpy.array(
+            [self.machines.get(machine, {}).get("last_time_ns", earliest) for machine in distinct] + [earliest],
+            dtype="int64",
+        )[codes]
+        keep = times > watermarks
+        machines, times, power = machines[keep], times[keep], power[keep]
+        if len(machines) == 0:
+            return {}
+
+        # previous last samples of the machines being updated lead into the new ones
+        carried = [machine for machine in pandas.unique(machines) if machine in self.machines]
+        machines = numpy.concatenate([numpy.array(carried, dtype=object), machines])
+        times = numpy.concatenate(
+            [numpy.array([self.machines[machine]["last_time_ns"] for machine in carried], dtype="int64"), times]
+        )
+        power = numpy.concatenate(
+            [numpy.array([self.machines[machine]["last_power"] for machine in carried], dtype=float), power]
+        )
+
+        integrals = trapezoid_by_group(machines, times // 10**9, power, max_gap=max_gap)
+        increments = {}
+        for machine, integral, last_row in zip(
+            integrals.index, integrals["integral"].to_numpy() / 3600, integrals["last_row"]  # seconds in hour
+        ):
+            state = self.machines.get(machine)
+            self.machines[machine] = {
+                "last_time_ns": int(times[last_row]),
+                "last_power": float(power[last_row]),
+                "total": (state["total"] if state is not None else 0.0) + float(integral),
+            }
+            increments[machine] = float(integral)
+        return increments
+
+    def totals(self):
+        return {machine: state["total"] for machine, state in self.machines.items()}
+
+    def reset(self, machine=None):
+        if machine is None:
+            self.machines = {}
+        else:
+            self.machines.pop(machine, None)
+        self.save()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Unable to load energy state from {self.path}: {e}")
+            return
+        self.machines = stored.get(self.name, {})
+        logger.info(f"Loaded energy state for {len(self.machines)} machine(s) from {self.path}")
+
+    def save(self):
+        try:
+            try:
+                with open(self.path, "r") as f:
+                    stored = json.load(f)
+            except (FileNotFoundError, ValueError):
+                stored = {}
+            stored[self.name] = self.machines
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(stored, f)
+            os.replace(temp_path, self.path)  # a crash mid-write can't lose the totals
+        except Exception as e:
+            logger.error(f"Unable to save energy state to {self.path}: {e}")
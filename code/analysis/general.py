@@ -1,4 +1,5 @@
-from pandas import DataFrame
+import numpy
+from pandas import DataFrame, MultiIndex
 from math import isnan
 
 def period_over_period_buckets(
@@ -65,3 +66,60 @@ def period_over_period_buckets(
 
         return formated_output
     return wrapped
+
+
+def period_over_period_pivot(
+    series_keys,
+    bucket_keys,
+    timestamp_key="_time",
+    value_key="_value",
+):
+    """Vectorised period_over_period_buckets, with the same output.
+
+    series_keys and bucket_keys are applied once to the whole timestamp column and must return
+    a tuple (sortable_keys, labels) of equal length Series/arrays, e.g. using dt accessors:
+    ``lambda ts: (ts.dt.year, ts.dt.year.astype(str))``
+    """
+
+    async def wrapped(data_frame: DataFrame):
+        data = data_frame[data_frame[value_key].notna()]
+        timestamps = data[timestamp_key]
+        series_sort, series_label = series_keys(timestamps)
+        bucket_sort, bucket_label = bucket_keys(timestamps)
+        frame = DataFrame(
+            {
+                "series_sort": numpy.asarray(series_sort),
+                "series_label": numpy.asarray(series_label),
+                "bucket_sort": numpy.asarray(bucket_sort),
+                "bucket_label": numpy.asarray(bucket_label),
+                "value": data[value_key].to_numpy(),
+            }
+        )
+
+        # later values for the same (bucket, series) replace earlier ones
+        grid = frame.pivot_table(
+            index=["bucket_sort", "bucket_label"],
+            columns=["series_sort", "series_label"],
+            values="value",
+            aggfunc="last",
+        )
+        # ascending on the sortable key, ties in order of first appearance
+        bucket_order = _first_seen_sorted(frame, "bucket_sort", "bucket_label")
+        series_order = _first_seen_sorted(frame, "series_sort", "series_label")
+        grid = grid.reindex(index=bucket_order, columns=series_order)
+        grid = grid.astype(object).where(grid.notna(), None)
+
+        return {
+            "buckets": bucket_order.get_level_values(1).tolist(),
+            "series": {
+                series_key[1]: grid[series_key].tolist() for series_key in series_order
+            },
+        }
+
+    return wrapped
+
+
+def _first_seen_sorted(frame, sort_column, label_column):
+    keys = frame[[sort_column, label_column]].drop_duplicates()
+    keys = keys.sort_values(sort_column, kind="stable")
+    return MultiIndex.from_frame(keys)
@@ -0,0 +1,36 @@
+import numpy
+import pandas
+
+
+def trapezoid_by_group(groups, time_seconds, values, max_gap=None):
+    """Trapezoid integral of values over time for every group in one pass over flat arrays.
+
+    Rows are sorted once by (group, time), the area of every interval is computed for the
+    whole array at once, and intervals that cross a group boundary, touch a NaN value or
+    (with ``max_gap`` seconds set) are longer than ``max_gap`` are masked out before the
+    areas are summed per group. Rows whose group is missing (None/NaN) are ignored.
+
+    Returns a DataFrame indexed by group (sorted) with columns integral and last_row, the
+    position in the input of each group's latest sample.
+    """
+    codes, labels = pandas.factorize(numpy.asarray(groups), sort=True)
+    time_seconds = numpy.asarray(time_seconds)
+    values = numpy.asarray(values, dtype=float)
+
+    rows = numpy.flatnonzero(codes >= 0)
+    rows = rows[numpy.lexsort((time_seconds[rows], codes[rows]))]
+    codes, time_seconds, values = codes[rows], time_seconds[rows], values[rows]
+
+    gaps = numpy.diff(time_seconds).astype(float)
+    areas = gaps * (values[1:] + values[:-1]) / 2
+    valid = (codes[1:] == codes[:-1]) & ~numpy.isnan(areas)
+    if max_gap is not None:
+        valid &= gaps <= max_gap
+    integrals = numpy.bincount(codes[1:][valid], weights=areas[valid], minlength=len(labels))
+
+    # each group's segment ends where the next one starts
+    ends = numpy.flatnonzero(numpy.append(codes[1:] != codes[:-1], len(codes) > 0))
+    return pandas.DataFrame(
+        {"integral": integrals, "last_row": rows[ends]},
+        index=pandas.Index(labels, name="group"),
+    )
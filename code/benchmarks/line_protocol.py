@@ -0,0 +1,103 @@
+"""Equivalence check and benchmark for output.influx.data_frame_to_line_protocol
+
+Compares the column-wise serialiser with the row by row one it falls back to
+(_data_frame_to_line_protocol_rows) byte for byte: NaN fields, float32, integer and
+bool fields, tag values and string fields that need escaping, None, categorical tags,
+extension dtypes and empty frames. Then times both.
+
+Run from the code directory:
+
+    python -m benchmarks.line_protocol [rows]
+"""
+import sys
+import time
+
+import numpy
+import pandas
+from pandas import DataFrame
+
+from output.influx import _data_frame_to_line_protocol_rows, data_frame_to_line_protocol
+
+TAGS = ["machine", "phase"]
+FIELDS = ["energy", "f32", "count", "flag", "text"]
+
+
+def make_frame(rows, machines=50, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return DataFrame(
+        {
+            "_time": pandas.date_range("2025-01-01", periods=rows, freq="5s", tz="UTC"),
+            "machine": rng.choice([f"m {i}" for i in range(machines)] + ["a,b=c"], rows),
+            "phase": rng.choice(["A", "B", "C"], rows),
+            "energy": numpy.where(rng.random(rows) < 0.1, numpy.nan, rng.random(rows) * 1000),
+            "f32": (rng.random(rows) * 100).astype("float32"),
+            "count": rng.integers(0, 100, rows),
+            "flag": rng.random(rows) < 0.5,
+            "text": rng.choice(['x"y', "a\\b", None, "plain", numpy.nan], rows),
+        }
+    )
+
+
+def cases():
+    data_frame = make_frame(3000)
+    yield "all field types", data_frame, "m x", TAGS, FIELDS
+    yield "no tags", data_frame, "m", [], ["energy"]
+
+    only_none = data_frame.copy()
+    only_none["text"] = [None] * len(only_none)
+    yield "all None string field", only_none, "m", TAGS, ["text", "energy"]
+
+    categorical = data_frame.copy()
+    categorical["machine"] = categorical["machine"].astype("category")
+    yield "categorical tag", categorical, "m", TAGS, FIELDS
+
+    extension = data_frame.copy()
+    extension["energy"] = extension["energy"].astype("Float64")
+    yield "extension dtype field", extension, "m", TAGS, ["energy", "count"]
+
+    yield "empty", data_frame.iloc[:0], "m", TAGS, FIELDS
+
+
+def serialise(function, data_frame, measurement, tag_cols, field_cols):
+    return function(
+        data_frame,
+        measurement,
+        timestamp_col="_time",
+        tag_cols=tag_cols,
+        field_cols=field_cols,
+    )
+
+
+def check():
+    for name, data_frame, measurement, tag_cols, field_cols in cases():
+        expected = serialise(_data_frame_to_line_protocol_rows, data_frame, measurement, tag_cols, field_cols)
+        actual = serialise(data_frame_to_line_protocol, data_frame, measurement, tag_cols, field_cols)
+        if actual != expected:
+            first = next(
+                (i for i, (a, e) in enumerate(zip(actual, expected)) if a != e),
+                min(len(actual), len(expected)),
+            )
+            raise AssertionError(
+                f"{name}: {len(actual)} lines vs {len(expected)} expected, first difference at line {first}"
+            )
+        print(f"equal: {name}")
+
+
+def benchmark(rows):
+    data_frame = make_frame(rows, seed=1)
+    fields = ["energy", "count"]
+    # the row by row serialiser takes tens of microseconds a row, so it only gets a slice
+    reference_rows = min(rows, 100_000)
+    for name, function, frame in (
+        ("row by row", _data_frame_to_line_protocol_rows, data_frame.iloc[:reference_rows]),
+        ("column-wise", data_frame_to_line_protocol, data_frame),
+    ):
+        start = time.perf_counter()
+        serialise(function, frame, "energy", TAGS, fields)
+        elapsed = time.perf_counter() - start
+        print(f"{name:12s} {len(frame):>8} rows {elapsed:.3f}s {elapsed / len(frame) * 1e6:.2f}us/row")
+
+
+if __name__ == "__main__":
+    check()
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
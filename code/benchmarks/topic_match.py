@@ -0,0 +1,130 @@
+"""Equivalence check and benchmark for trigger.mqtt_event.topic_trie.TopicTrie
+
+Registers the same filters in TopicTrie and in the original recursive tree search
+(kept below as the reference) and checks both find the same functions for every topic,
+with and without the LRU cache, including + and # wildcards at every level, a function
+registered under several filters and topics that match nothing. Then times lookups for
+the original search, the trie without a cache and the trie with the default cache.
+
+Run from the code directory:
+
+    python -m benchmarks.topic_match [lookups]
+"""
+import random
+import sys
+import time
+
+from trigger.mqtt_event.topic_trie import TopicTrie
+
+
+class ReferenceNode:
+    def __init__(self):
+        self.value = set()
+        self.next = {}
+
+
+def reference_add(tokens, current_level, func):
+    """The original add_to_tree"""
+    token = tokens.pop(0)
+    if token not in current_level.next:
+        current_level.next[token] = ReferenceNode()
+    if len(tokens) == 0 or token == "#":
+        current_level.next[token].value.add(func)
+    else:
+        reference_add(tokens, current_level.next[token], func)
+
+
+def reference_search(tokens, current_level):
+    """The original recursive_search"""
+    function_set = set()
+    if len(tokens) == 0:
+        function_set.update(current_level.value)
+        return function_set
+
+    token = tokens[0]
+    if token in current_level.next:
+        function_set.update(reference_search(tokens[1:], current_level.next[token]))
+    if "+" in current_level.next:
+        function_set.update(reference_search(tokens[1:], current_level.next["+"]))
+    if "#" in current_level.next:
+        function_set.update(current_level.next["#"].value)
+    return function_set
+
+
+def make_filters(machines):
+    filters = [
+        "power_monitoring/+/+/power",
+        "power_monitoring/#",
+        "status/+/state",
+        "+/+/+/current",
+        "+/#",
+        "#",
+        "alerts/#",
+        "alerts/+/y/#",
+        "status/machine-1/state",
+    ]
+    filters += [f"power_monitoring/site1/machine-{i}/power" for i in range(0, machines, 4)]
+    return filters
+
+
+def make_topics(machines):
+    topics = [
+        f"power_monitoring/site{site}/machine-{i}/{kind}"
+        for site in (1, 2)
+        for i in range(machines)
+        for kind in ("power", "current")
+    ]
+    topics += [f"status/machine-{i}/state" for i in range(machines)]
+    topics += ["alerts", "alerts/x", "alerts/x/y", "alerts/x/y/z", "nomatch/a", "power_monitoring", "a//b", ""]
+    return topics
+
+
+def build(filters, cache_size):
+    reference = ReferenceNode()
+    trie = TopicTrie(cache_size=cache_size)
+    shared = "shared"
+    for position, topic_filter in enumerate(filters):
+        func = shared if position % 5 == 0 else position
+        reference_add(topic_filter.split("/"), reference, func)
+        trie.add(topic_filter, func)
+    return reference, trie
+
+
+def check(machines=500):
+    filters = make_filters(machines)
+    topics = make_topics(machines)
+    reference, trie = build(filters, cache_size=4096)
+    _, uncached = build(filters, cache_size=0)
+    for topic in topics:
+        expected = reference_search(topic.split("/"), reference)
+        for name, matcher in (("uncached", uncached), ("cached", trie), ("cache hit", trie)):
+            funcs = matcher.match(topic)
+            if len(funcs) != len(set(funcs)) or set(funcs) != expected:
+                raise AssertionError(f"{name} match for {topic!r}: {funcs} != {expected}")
+    print(f"equal: {len(filters)} filters, {len(topics)} topics")
+
+
+def benchmark(lookups, machines=2000):
+    filters = make_filters(machines)
+    topics = make_topics(machines)
+    reference, trie = build(filters, cache_size=4096)
+    _, uncached = build(filters, cache_size=0)
+    rng = random.Random(0)
+    for label, working_set in (("all topics", topics), ("3000 hot topics", topics[:3000])):
+        stream = [rng.choice(working_set) for _ in range(lookups)]
+        print(f"{label}: {len(filters)} filters, {len(working_set)} distinct topics, {lookups} lookups")
+        for name, lookup in (
+            ("recursive search", lambda topic: reference_search(topic.split("/"), reference)),
+            ("trie, no cache", uncached.match),
+            ("trie + cache", trie.match),
+        ):
+            start = time.perf_counter()
+            for topic in stream:
+                lookup(topic)
+            elapsed = time.perf_counter() - start
+            print(f"  {name:16s} {elapsed:.3f}s {elapsed / lookups * 1e6:.2f}us/lookup")
+
+
+if __name__ == "__main__":
+    check()
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
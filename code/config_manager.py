@@ -144,6 +144,13 @@ def do_combine(original, new):
             original[k] = v
 
 
+def is_true(value):
+    """Truth of a config flag - values overridden from environment variables arrive as strings"""
+    if isinstance(value, str):
+        return value.strip().lower() not in ("", "0", "false", "no", "off")
+    return bool(value)
+
+
 def env_var_overwrite(config, parent=None):
     for key, value in config.items():
         current_key = f"{parent}__{key.upper()}" if parent else key.upper()
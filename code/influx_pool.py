@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+logger = logging.getLogger(__name__)
+
+
+class InfluxClientPool:
+    """Long-lived InfluxDBClientAsync instances shared between queries and writes.
+
+    One client (and so one aiohttp session with keep-alive connections) is kept per
+    (url, org, token, gzip, stream). Concurrent use of each client is capped by a semaphore.
+    Streamed queries hold their client until the consumer has read the whole response,
+    and the consumer may itself write to influx, so they get separate clients (and
+    slots) rather than holding ones a write is waiting for.
+    The TriggerEngine configures the pool on start up and closes it on shutdown.
+    """
+
+    inst = None
+
+    @classmethod
+    def get_inst(cls) -> "InfluxClientPool":
+        if cls.inst is None:
+            cls.inst = cls()
+        return cls.inst
+
+    def __init__(self):
+        self.max_concurrent_requests = 8
+        self.timeout_ms = 60000
+        self.__clients = {}
+        self.__semaphores = {}
+        self.__loop = None
+
+    def configure(self, influx_config):
+        self.max_concurrent_requests = int(
+            influx_config.get("max_concurrent_requests", self.max_concurrent_requests)
+        )
+        self.timeout_ms = int(influx_config.get("timeout_ms", self.timeout_ms))
+
+    @asynccontextmanager
+    async def client(self, url, token, org, gzip=False, stream=False):
+        loop = asyncio.get_running_loop()
+        if self.__loop is not loop:
+            # clients are bound to the event loop they were created in
+            self.__clients = {}
+            self.__semaphores = {}
+            self.__loop = loop
+
+        key = (url, org, token, gzip, stream)
+        if key not in self.__clients:
+            logger.info(f"Creating pooled influx client for {url} ({org})")
+            self.__clients[key] = InfluxDBClientAsync(
+                url=url,
+                token=token,
+                org=org,
+                timeout=self.timeout_ms,
+                enable_gzip=gzip,
+                connection_pool_maxsize=self.max_concurrent_requests,
+            )
+            self.__semaphores[key] = asyncio.Semaphore(self.max_concurrent_requests)
+
+        async with self.__semaphores[key]:
+            yield self.__clients[key]
+
+    async def close(self):
+        clients = list(self.__clients.values())
+        self.__clients = {}
+        self.__semaphores = {}
+        for client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                logger.error(f"Error while closing influx client: {e}")
+        if clients:
+            logger.info(f"Closed {len(clients)} pooled influx client(s)")
@@ -0,0 +1,176 @@
+import logging
+import time
+import io
+import pstats
+import cProfile
+from pandas import DataFrame
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+logger = logging.getLogger(__name__)
+
+# whether to compute DataFrame.memory_usage(deep=True) for every stage - this walks object columns, which can
+# cost more than the stage itself on large frames, so by default memory is only measured on profiled runs
+measure_memory = False
+
+# number of upcoming pipelines that should have their stages profiled
+_profile_requests = 0
+_profiling_active = False
+
+
+def log_sink(stats):
+    profile = stats.pop("profile", None)
+    logger.debug(
+        f"{stats['pipeline']} | {stats['stage']} | wall: {stats['wall_s']:.4f}s cpu: {stats['cpu_s']:.4f}s"
+        f" | rows: {stats['rows_in']} -> {stats['rows_out']}"
+        f" | memory: {stats['memory_in']} -> {stats['memory_out']} bytes"
+    )
+    if profile:
+        logger.info(f"Profile for {stats['pipeline']} | {stats['stage']}:\n{profile}")
+
+
+class StatsRegistry:
+    """In-process aggregate of stage stats, keyed on (pipeline, stage)"""
+
+    inst = None
+
+    @classmethod
+    def get_inst(cls) -> "StatsRegistry":
+        if cls.inst is None:
+            cls.inst = cls()
+        return cls.inst
+
+    def __init__(self):
+        self.stages = {}
+
+    def __call__(self, stats):
+        key = (stats["pipeline"], stats["stage"])
+        entry = self.stages.get(key)
+        if entry is None:
+            entry = {"count": 0, "wall_s_total": 0.0, "wall_s_max": 0.0, "cpu_s_total": 0.0}
+            self.stages[key] = entry
+        entry["count"] += 1
+        entry["wall_s_total"] += stats["wall_s"]
+        entry["wall_s_max"] = max(entry["wall_s_max"], stats["wall_s"])
+        entry["cpu_s_total"] += stats["cpu_s"]
+        entry["last"] = stats
+
+    def summary(self):
+        return {
+            f"{pipeline} | {stage}": {
+                **entry,
+                "wall_s_mean": entry["wall_s_total"] / entry["count"],
+            }
+            for (pipeline, stage), entry in self.stages.items()
+        }
+
+    def reset(self):
+        self.stages = {}
+
+
+sinks = [log_sink]
+
+
+def add_sink(sink):
+    """sink is any callable that accepts a stats dict"""
+    sinks.append(sink)
+
+
+def remove_sink(sink):
+    sinks.remove(sink)
+
+
+def request_profile(count=1):
+    """Profile every stage of the next ``count`` pipelines that are started"""
+    global _profile_requests
+    _profile_requests += count
+
+
+def claim_profile_request():
+    global _profile_requests
+    if _profile_requests > 0:
+        _profile_requests -= 1
+        return True
+    return False
+
+
+def frame_info(data, memory=False):
+    if isinstance(data, DataFrame):
+        return len(data), int(data.memory_usage(deep=True).sum()) if memory else None
+    return None, None
+
+
+class StageTimer:
+    """Context manager that measures one stage and sends the result to all sinks.
+
+    CPU time is process wide, so it includes anything else the event loop ran while the stage was awaiting.
+    """
+
+    def __init__(self, pipeline_name, stage_name, data_in, profile=False):
+        self.pipeline_name = pipeline_name
+        self.stage_name = stage_name
+        self.profile = profile
+        self.measure_memory = measure_memory or profile
+        self.rows_in, self.memory_in = frame_info(data_in, self.measure_memory)
+        self.profiler = None
+        self.data_out = None
+
+    def __enter__(self):
+        global _profiling_active
+        if self.profile and not _profiling_active:
+            _profiling_active = True  # only one profiler can be active at a time
+            if pyinstrument is not None:
+                self.profiler = pyinstrument.Profiler(async_mode="enabled")
+                self.profiler.start()
+            else:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _profiling_active
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        profile = None
+        if self.profiler is not None:
+            if pyinstrument is not None:
+                self.profiler.stop()
+                profile = self.profiler.output_text()
+            else:
+                self.profiler.disable()
+                stream = io.StringIO()
+                pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(20)
+                profile = stream.getvalue()
+            _profiling_active = False
+
+        rows_out, memory_out = frame_info(self.data_out, self.measure_memory)
+        stats = {
+            "pipeline": self.pipeline_name,
+            "stage": self.stage_name,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "rows_in": self.rows_in,
+            "rows_out": rows_out,
+            "memory_in": self.memory_in,
+            "memory_out": memory_out,
+            "error": exc_type.__name__ if exc_type is not None else None,
+        }
+        if profile:
+            stats["profile"] = profile
+        for sink in sinks:
+            try:
+                sink(dict(stats))
+            except Exception:
+                logger.exception(f"Instrumentation sink {sink} failed")
+        return False
+
+
+def stage_name(func):
+    # stages are closures returned by factories like calculate_power(config) so __qualname__ is "calculate_power.<locals>.wrapped"
+    name = getattr(func, "__qualname__", None) or repr(func)
+    return name.replace(".<locals>.wrapped", "").replace(".<locals>", "")
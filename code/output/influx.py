@@ -1,33 +1,54 @@
 from functools import lru_cache, cache
 import logging
-from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
-from pandas import DataFrame
+from collections.abc import AsyncIterable
+from influx_pool import InfluxClientPool
+from config_manager import is_true
+from .influx_writer import BackgroundWriter
+from pandas import DataFrame, Series
 from math import isnan
+import numpy
 
 
 logger = logging.getLogger(__name__)
 
 
-def write(config, measurement_name,timestamp_col = "_time",tag_cols = [], field_cols = []):
+def write(config, measurement_name,timestamp_col = "_time",tag_cols = [], field_cols = [], background=None):
+    """background=True hands the points to the BackgroundWriter and returns as soon as they are queued,
+    defaults to the influx.background_writes config setting (False if not set)"""
     influx_conf = config["influx"]
     bucket = influx_conf.get("bucket")
+    if background is None:
+        background = is_true(influx_conf.get("background_writes", False))
+
+    async def write_frame(data_frame):
+        line_protocol = data_frame_to_line_protocol(
+            data_frame,
+            measurement_name,
+            timestamp_col=timestamp_col,
+            tag_cols=tag_cols,
+            field_cols=field_cols,
+        )
+        # logger.info(line_protocol)
+        if background:
+            BackgroundWriter.get_inst().enqueue(
+                influx_conf["url"], influx_conf["token"], influx_conf["org"], bucket, line_protocol
+            )
+            return
 
-    async def wrapped(data_frame):
-        async with InfluxDBClientAsync(
-            url=influx_conf["url"], token=influx_conf["token"], org=influx_conf["org"]
+        async with InfluxClientPool.get_inst().client(
+            influx_conf["url"], influx_conf["token"], influx_conf["org"]
         ) as client:
             write_api = client.write_api()
-
-            line_protocol = data_frame_to_line_protocol(
-                data_frame,
-                measurement_name,
-                timestamp_col=timestamp_col,
-                tag_cols=tag_cols,
-                field_cols=field_cols,
-            )
-            # logger.info(line_protocol)
             await write_api.write(bucket, influx_conf["org"], record=line_protocol)
 
+    async def wrapped(data_frame):
+        if isinstance(data_frame, AsyncIterable):
+            # stream of chunks - each is written as it arrives, nothing is passed on
+            async for chunk in data_frame:
+                await write_frame(chunk)
+            return None
+
+        await write_frame(data_frame)
         return data_frame
 
     return wrapped
@@ -35,6 +56,99 @@ def write(config, measurement_name,timestamp_col = "_time",tag_cols = [], field_
 
 def data_frame_to_line_protocol(
     data_frame: DataFrame, measurement, *, timestamp_col, tag_cols, field_cols
+):
+    """Serialise a DataFrame to a list of line protocol lines (as bytes), one per row that has at least one field.
+
+    Works column-wise: tag values are escaped once per unique value, numeric fields are formatted as whole
+    columns and missing values are masked per column. Columns with types the column-wise path doesn't handle
+    (e.g. pandas extension dtypes or mixed object columns) fall back to the row-by-row serialiser.
+    """
+    if len(data_frame) == 0:
+        return []
+
+    timestamps = _timestamp_strings(data_frame[timestamp_col])
+    tags = _tag_strings(data_frame, tag_cols)
+    field_exprs = [
+        _field_strings(data_frame[field_name], escape_field_key(field_name))
+        for field_name in field_cols
+    ]
+    if timestamps is None or tags is None or any(exprs is None for exprs in field_exprs):
+        return _data_frame_to_line_protocol_rows(
+            data_frame,
+            measurement,
+            timestamp_col=timestamp_col,
+            tag_cols=tag_cols,
+            field_cols=field_cols,
+        )
+
+    fields = Series(None, index=data_frame.index, dtype=object)
+    for exprs in field_exprs:
+        has_current = exprs.notna()
+        both = has_current & fields.notna()
+        only_current = has_current & ~both
+        fields[both] = fields[both] + "," + exprs[both]
+        fields[only_current] = exprs[only_current]
+
+    has_fields = fields.notna()
+    lines = (
+        f"{escape_measurement(measurement)},"
+        + tags[has_fields]
+        + " "
+        + fields[has_fields]
+        + " "
+        + timestamps[has_fields]
+    )
+    return [line.encode("utf-8") for line in lines]
+
+
+def _timestamp_strings(column):
+    if not hasattr(column, "dt"):
+        return None
+    # int64 nanoseconds, the same as Timestamp.value
+    return column.dt.as_unit("ns").astype("int64").astype(str).astype(object)
+
+
+def _tag_strings(data_frame, tag_cols):
+    tags = Series("", index=data_frame.index, dtype=object)
+    for position, tag_name in enumerate(tag_cols):
+        column = data_frame[tag_name]
+        unique_values = column.unique()
+        if not all(isinstance(value, str) for value in unique_values):
+            return None
+        key = escape_tag_key(tag_name)
+        escaped = {value: f"{key}={escape_tag_value(value)}" for value in unique_values}
+        tag_exprs = column.map(escaped).astype(object)
+        tags = tag_exprs if position == 0 else tags + "," + tag_exprs
+    return tags
+
+
+def _field_strings(column, key):
+    """``key=value`` strings for one field column, None where the row has no value for this field.
+
+    Returns None (rather than a Series) if the column's type isn't handled column-wise.
+    """
+    dtype = column.dtype
+    if isinstance(dtype, numpy.dtype) and dtype.kind in "biu":
+        # bool is an int subclass so the row-wise serialiser writes these as e.g. Truei too
+        return (key + "=" + column.astype(str) + "i").astype(object)
+    if isinstance(dtype, numpy.dtype) and dtype.kind == "f":
+        # formatted via float64 so float32 values get the same digits as str() of a python float
+        exprs = (key + "=" + column.astype("float64").astype(str)).astype(object)
+        return exprs.where(column.notna(), None)
+    if dtype == object:
+        missing = column.isna()
+        present = column[~missing]
+        if not present.map(type).eq(str).all():
+            return None
+        escaped = present.map(escape_field_value)
+        exprs = Series(None, index=column.index, dtype=object)
+        exprs[~missing] = key + '="' + escaped + '"'
+        return exprs
+    return None
+
+
+def _data_frame_to_line_protocol_rows(
+    data_frame: DataFrame, measurement, *, timestamp_col, tag_cols, field_cols
 ):
     serialized_dataframe = []
     for index, row in data_frame.iterrows():
@@ -0,0 +1,241 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from influxdb_client.rest import ApiException
+from influx_pool import InfluxClientPool
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWriter:
+    """Batches line protocol from output.influx.write and sends it to influx in the background.
+
+    Lines are buffered per (url, org, bucket) and flushed (gzipped) once ``batch_lines``
+    are waiting or the oldest has waited ``linger_seconds``, with up to
+    ``max_concurrent_flushes`` batches in flight. If influx can't be reached, or more than
+    ``max_queued_lines`` are buffered, batches are spilled to gzipped files in ``spool_dir``
+    which are replayed oldest first once influx is reachable again. While anything is
+    spooled new batches are spooled too, so replay keeps the order they were produced in.
+    Batches influx rejects as invalid (4xx other than 429) are logged and dropped.
+    """
+
+    inst = None
+
+    @classmethod
+    def get_inst(cls) -> "BackgroundWriter":
+        if cls.inst is None:
+            cls.inst = cls()
+        return cls.inst
+
+    def __init__(self):
+        self.max_queued_lines = 100000
+        self.batch_lines = 5000
+        self.linger_seconds = 1.0
+        self.max_concurrent_flushes = 2
+        self.retry_seconds = 10
+        self.spool_dir = "/app/data/influx_spool"
+
+        self.__buffers = {}
+        self.__queued_lines = 0
+        self.__tokens = {}
+        self.__in_flight = set()
+        self.__spooling = False
+        self.__wakeup = None
+        self.__semaphore = None
+
+        self.lines_written = 0
+        self.lines_spooled = 0
+        self.lines_dropped = 0
+
+    def configure(self, influx_config):
+        self.max_queued_lines = int(influx_config.get("write_queue_max_lines", self.max_queued_lines))
+        self.batch_lines = int(influx_config.get("write_batch_lines", self.batch_lines))
+        self.linger_seconds = float(influx_config.get("write_linger_seconds", self.linger_seconds))
+        self.max_concurrent_flushes = int(influx_config.get("write_max_concurrent_flushes", self.max_concurrent_flushes))
+        self.retry_seconds = float(influx_config.get("write_retry_seconds", self.retry_seconds))
+        self.spool_dir = influx_config.get("write_spool_dir", self.spool_dir)
+        if "url" in influx_config and "org" in influx_config:
+            # so spooled batches from a previous run can be replayed before anything new is queued
+            self.__tokens[(influx_config["url"], influx_config["org"])] = influx_config.get("token")
+
+    def enqueue(self, url, token, org, bucket, lines):
+        if not lines:
+            return
+        target = (url, org, bucket)
+        self.__tokens[(url, org)] = token
+
+        if self.__queued_lines + len(lines) > self.max_queued_lines:
+            logger.warning(f"Influx write queue full ({self.__queued_lines} lines), spooling {len(lines)} lines to disk")
+            # what's already queued goes to the spool first so the replay keeps lines in order
+            self.__spool_buffers()
+            self.__spool(target, lines)
+            return
+
+        buffer = self.__buffers.get(target)
+        if buffer is None or len(buffer["lines"]) == 0:
+            buffer = {"lines": [], "since": time.monotonic()}
+            self.__buffers[target] = buffer
+        buffer["lines"].extend(lines)
+        self.__queued_lines += len(lines)
+
+        if len(buffer["lines"]) >= self.batch_lines and self.__wakeup is not None:
+            self.__wakeup.set()
+
+    def stats(self):
+        spool_files = self.__spool_files()
+        oldest = None
+        if spool_files:
+            oldest = time.time() - int(spool_files[0].split("-")[0]) / 10**9
+        return {
+            "queued_lines": self.__queued_lines,
+            "in_flight_batches": len(self.__in_flight),
+            "spooled_batches": len(spool_files),
+            "oldest_spooled_seconds": oldest,
+            "lines_written": self.lines_written,
+            "lines_spooled": self.lines_spooled,
+            "lines_dropped": self.lines_dropped,
+        }
+
+    async def run(self):
+        self.__wakeup = asyncio.Event()
+        self.__semaphore = asyncio.Semaphore(self.max_concurrent_flushes)
+        self.__spooling = len(self.__spool_files()) > 0
+        next_replay = 0
+
+        while True:
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout=self.linger_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.__wakeup.clear()
+
+            self.__flush(force=False)
+
+            if self.__spooling and time.monotonic() >= next_replay:
+                if not await self.__replay_spool():
+                    next_replay = time.monotonic() + self.retry_seconds
+
+    async def close(self):
+        """Spool anything still buffered and give in-flight batches a moment to finish"""
+        self.__spool_buffers()
+        if self.__in_flight:
+            await asyncio.wait(self.__in_flight, timeout=5)
+
+    def __spool_buffers(self):
+        for target, buffer in self.__buffers.items():
+            if buffer["lines"]:
+                self.__spool(target, buffer["lines"])
+        self.__buffers = {}
+        self.__queued_lines = 0
+
+    def __flush(self, force):
+        now = time.monotonic()
+        for target, buffer in self.__buffers.items():
+            lines = buffer["lines"]
+            if not lines:
+                continue
+            if not force and len(lines) < self.batch_lines and now - buffer["since"] < self.linger_seconds:
+                continue
+            buffer["lines"] = []
+            self.__queued_lines -= len(lines)
+            for index in range(0, len(lines), self.batch_lines):
+                batch = lines[index : index + self.batch_lines]
+                if self.__spooling:
+                    self.__spool(target, batch)
+                else:
+                    task = asyncio.create_task(self.__send(target, batch))
+                    self.__in_flight.add(task)
+                    task.add_done_callback(self.__in_flight.discard)
+
+    async def __send(self, target, batch):
+        async with self.__semaphore:
+            try:
+                await self.__write(target, batch)
+                self.lines_written += len(batch)
+            except Exception as e:
+                if is_rejected(e):
+                    logger.error(f"Influx rejected batch of {len(batch)} lines, dropping it: {e}")
+                    self.lines_dropped += len(batch)
+                else:
+                    logger.error(f"Unable to write to influx, spooling {len(batch)} lines to disk: {e}")
+                    self.__spool(target, batch)
+
+    async def __write(self, target, batch):
+        url, org, bucket = target
+        token = self.__tokens.get((url, org))
+        async with InfluxClientPool.get_inst().client(url, token, org, gzip=True) as client:
+            await client.write_api().write(bucket, org, record=batch)
+
+    async def __replay_spool(self):
+        while True:
+            # batches spooled while replaying are picked up by the next pass
+            filenames = self.__spool_files()
+            if not filenames:
+                break
+            for filename in filenames:
+                path = os.path.join(self.spool_dir, filename)
+                try:
+                    target, batch = read_spool_file(path)
+                except Exception as e:
+                    logger.error(f"Unreadable influx spool file {path}, removing it: {e}")
+                    os.remove(path)
+                    continue
+                if self.__tokens.get((target[0], target[1])) is None:
+                    logger.warning(f"No token known for {target[0]} ({target[1]}), can't replay spooled writes yet")
+                    return False
+
+                try:
+                    await self.__write(target, batch)
+                    self.lines_written += len(batch)
+                except Exception as e:
+                    if not is_rejected(e):
+                        logger.warning(f"Influx still unavailable, {len(self.__spool_files())} spooled batches waiting: {e}")
+                        return False
+                    logger.error(f"Influx rejected spooled batch of {len(batch)} lines, dropping it: {e}")
+                    self.lines_dropped += len(batch)
+                os.remove(path)
+
+        logger.info("Influx spool replayed")
+        self.__spooling = False
+        return True
+
+    def __spool(self, target, lines):
+        # once anything is spooled, later batches queue behind it until the replay has caught up
+        self.__spooling = True
+        os.makedirs(self.spool_dir, exist_ok=True)
+        # time_ns prefix keeps files in the order they were written, including across restarts
+        filename = f"{time.time_ns()}-{os.getpid()}-{id(lines)}.lp.gz"
+        write_spool_file(os.path.join(self.spool_dir, filename), target, lines)
+        self.lines_spooled += len(lines)
+
+    def __spool_files(self):
+        if not os.path.isdir(self.spool_dir):
+            return []
+        return sorted(
+            filename for filename in os.listdir(self.spool_dir) if filename.endswith(".lp.gz")
+        )
+
+
+def is_rejected(exception):
+    # 4xx means the data itself was refused - retrying won't help (except rate limiting)
+    status = getattr(exception, "status", None) if isinstance(exception, ApiException) else None
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def write_spool_file(path, target, lines):
+    url, org, bucket = target
+    header = json.dumps({"url": url, "org": org, "bucket": bucket}).encode("utf-8")
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, "wb") as f:
+        f.write(b"\n".join([header, *[line if isinstance(line, bytes) else line.encode("utf-8") for line in lines]]))
+    os.replace(temp_path, path)  # so a crash mid-write can't leave a truncated file to replay
+
+
+def read_spool_file(path):
+    with gzip.open(path, "rb") as f:
+        header, *lines = f.read().split(b"\n")
+    header = json.loads(header)
+    return (header["url"], header["org"], header["bucket"]), lines
@@ -1,7 +1,13 @@
 import logging
+import asyncio
+import json
 from pandas import DataFrame
-import requests
+import aiohttp
 import time
+import hashlib
+import base64
+from .kinabase_id_map import IdMapStore
+from .kinabase_outbox import KinabaseOutbox, DeliveryFailed
 
 
 logger = logging.getLogger(__name__)
@@ -11,96 +17,281 @@ class TokenExpired(Exception):
     pass
 
 
+class KBResponse:
+    """Status and body of a completed Kinabase request (the body is read before the connection is released)"""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
 class KBManager:
     inst = {}
+    secrets = {}  # app_id -> secret, so queued writes can be delivered after a restart
+
+    # seconds
+    request_timeout = 30
+    keepalive_timeout = 60
+    max_connections = 10
+    id_map_ttl = 3600
+    id_map_negative_ttl = 600
+    max_id_map_pages = 1000
+    token_refresh_margin = 60
+    id_map_path = "/app/data/kinabase_id_map.json"
 
     @classmethod
     def get_inst(cls, app_id, secret, base_url) -> "KBManager":
+        if secret is not None:
+            cls.secrets[app_id] = secret
         if cls.inst.get(app_id) is None:
             cls.inst[app_id] = cls(app_id, secret, base_url)
         return cls.inst[app_id]
 
+    @classmethod
+    def configure(cls, kinabase_config):
+        cls.request_timeout = float(kinabase_config.get("request_timeout", cls.request_timeout))
+        cls.keepalive_timeout = float(kinabase_config.get("keepalive_timeout", cls.keepalive_timeout))
+        cls.max_connections = int(kinabase_config.get("max_connections", cls.max_connections))
+        cls.id_map_ttl = float(kinabase_config.get("id_map_ttl", cls.id_map_ttl))
+        cls.id_map_negative_ttl = float(kinabase_config.get("id_map_negative_ttl", cls.id_map_negative_ttl))
+        cls.id_map_path = kinabase_config.get("id_map_path", cls.id_map_path)
+        cls.token_refresh_margin = float(kinabase_config.get("token_refresh_margin", cls.token_refresh_margin))
+        if kinabase_config.get("app_id") is not None:
+            cls.secrets[kinabase_config["app_id"]] = kinabase_config.get("secret")
+
+    @classmethod
+    def for_app(cls, app_id, base_url) -> "KBManager":
+        return cls.get_inst(app_id, cls.secrets.get(app_id), base_url)
+
+    @classmethod
+    async def close_all(cls):
+        for kb in cls.inst.values():
+            await kb.close()
+
     def __init__(self, app_id, secret, base_url):
         self.__base_url = base_url
-        self._id_map = {}
+        self.id_maps = IdMapStore(
+            self.id_map_path, base_url, ttl=self.id_map_ttl, negative_ttl=self.id_map_negative_ttl
+        )
+        self.__refreshes = {}
+        self.last_sent = LastSentState()
 
         self._token = None
         self.app_id = app_id
         self.secret = secret
 
         self._token_expiry = 0
-
-    @property
-    def token(self):
-        if not self._token or time.time() > self._token_expiry - 60:
-            self._refresh_token()
+        self.__token_refresh = None
+        self.__token_timer = None
+        self.__session = None
+
+    def session(self) -> aiohttp.ClientSession:
+        # pooled keep-alive connections, created on first use inside the running event loop
+        if self.__session is None or self.__session.closed:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, keepalive_timeout=self.keepalive_timeout
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            )
+        return self.__session
+
+    async def request(self, method, url, **kwargs) -> KBResponse:
+        async with self.session().request(method, url, **kwargs) as resp:
+            return KBResponse(resp.status, await resp.text())
+
+    async def close(self):
+        if self.__token_timer is not None:
+            self.__token_timer.cancel()
+            self.__token_timer = None
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
+
+    async def token(self):
+        """Current token. Once within ``token_refresh_margin`` of expiry a refresh is started
+        in the background and the still valid token returned, only an expired (or missing)
+        token waits for the refresh."""
+        now = time.time()
+        if not self._token or now >= self._token_expiry:
+            await asyncio.shield(self.__start_token_refresh())
+        elif now >= self._token_expiry - self.token_refresh_margin:
+            self.__start_token_refresh()
         return self._token
 
-    def expire_token(self):
-        self._token_expiry = 0
+    def expire_token(self, token=None):
+        """Mark the token as rejected. With ``token`` given (the one a request was sent with) this
+        does nothing if the token has since been replaced, so a burst of 401s refreshes only once."""
+        if token is None or token == self._token:
+            self._token_expiry = 0
+
+    def __start_token_refresh(self):
+        # one refresh at a time, everyone waiting on a token shares it
+        if self.__token_refresh is None or self.__token_refresh.done():
+            self.__token_refresh = asyncio.create_task(self._refresh_token())
+        return self.__token_refresh
+
+    def __schedule_token_refresh(self):
+        if self.__token_timer is not None:
+            self.__token_timer.cancel()
+        delay = max(0, self._token_expiry - self.token_refresh_margin - time.time())
+        self.__token_timer = asyncio.get_running_loop().call_later(
+            delay, self.__start_token_refresh
+        )
 
-    def _refresh_token(self):
-        """Obtain a new JWT token using app_id/secret.  We store expiry as
-        roughly one hour from now since docs don't specify TTL.
-        """
+    async def _refresh_token(self):
+        """Obtain a new JWT token using app_id/secret. Expiry is taken from the token's
+        ``exp`` claim, or assumed to be roughly an hour if it doesn't have one."""
         if not self.app_id or not self.secret:
             return
         url = f"{self.__base_url}/token"
         try:
-            resp = requests.post(
-                url, json={"appId": self.app_id, "secret": self.secret}
+            resp = await self.request(
+                "post", url, json={"appId": self.app_id, "secret": self.secret}
             )
-            resp.raise_for_status()
+            if resp.status_code >= 400:
+                raise Exception(f"{resp.status_code}: {resp.text}")
             data = resp.json()
             self._token = data.get("token")
-            # naive expiry estimate
-            self._token_expiry = time.time() + 3500
-            logger.info("Obtained new Kinabase token")
+            self._token_expiry = jwt_expiry(self._token) or time.time() + 3500
+            self.__schedule_token_refresh()
+            logger.info(
+                f"Obtained new Kinabase token, expires in {self._token_expiry - time.time():.0f}s"
+            )
         except Exception as e:
             logger.error(f"Unable to refresh Kinabase token: {e}")
 
-    def id_map(self, collection: str, pk_field: str):
-        if not collection in self._id_map:
-            self.refresh_id_map(collection, pk_field)
-        elif pk_field not in self._id_map[collection]:
-            self.refresh_id_map(collection, pk_field)
-        return self._id_map.get(collection, {}).get(pk_field, {})
+    async def lookup_id(self, collection, pk_field, value):
+        """Kinabase record id of the record in collection whose pk_field is value, or None"""
+        if collection is None:
+            logger.error("No collection_id configured, cannot look up id")
+            return None
 
-    def refresh_id_map(self, collection_id, pk_field="machineName"):
+        await self.__ensure_fresh(collection, pk_field)
+        id = self.id_maps.get(collection, pk_field, value)
+        if id is not None or self.id_maps.is_known_missing(collection, pk_field, value):
+            return id
+
+        # a full fetch within the negative ttl counts as a negative result for anything not in it
+        if not self.id_maps.fetched_within(collection, pk_field, self.id_map_negative_ttl):
+            # may have been added since the last refresh - page through until it turns up
+            await asyncio.shield(self.__start_refresh(collection, pk_field, until=value))
+            id = self.id_maps.get(collection, pk_field, value)
+        if id is None:
+            self.id_maps.mark_missing(collection, pk_field, value)
+        return id
+
+    async def id_map(self, collection: str, pk_field: str):
+        await self.__ensure_fresh(collection, pk_field)
+        return self.id_maps.ids(collection, pk_field)
+
+    async def __ensure_fresh(self, collection, pk_field):
+        if not self.id_maps.is_stale(collection, pk_field):
+            return
+        refresh = self.__start_refresh(collection, pk_field)
+        if not self.id_maps.has_map(collection, pk_field):
+            await asyncio.shield(refresh)
+        # otherwise keep using the stale map while it refreshes in the background
+
+    def __start_refresh(self, collection, pk_field, until=None):
+        # one refresh at a time per map (and per value being searched for)
+        key = (collection, pk_field, until)
+        task = self.__refreshes.get(key)
+        if task is None:
+            task = asyncio.create_task(self.refresh_id_map(collection, pk_field, until=until))
+            self.__refreshes[key] = task
+            task.add_done_callback(lambda _task: self.__refreshes.pop(key, None))
+        return task
+
+    async def refresh_id_map(self, collection_id, pk_field="machineName", until=None):
+        """Fetch the collection page by page. With ``until`` set, stop as soon as a record
+        with that pk value is found (pages seen so far are merged into the map)."""
         if collection_id is None:
             logger.error("No collection_id configured, cannot refresh id map")
-            return
-        url = f"{self.__base_url}/collections/{collection_id}"
-        headers = {"Content-Type": "application/json"}
-        headers["Authorization"] = f"Bearer {self.token}"
-        try:
-            resp = requests.get(url, headers=headers)
-            if resp.status_code == 401:
-                # unauthorized: check status endpoint and try refreshing token then retry once
-                logger.warning("ID map fetch returned 401, checking auth status")
-                self._refresh_token()
-                headers["Authorization"] = f"Bearer {self.token}"
-                resp = requests.get(url, headers=headers)
+            return False
+
+        ids = {}
+        for index in range(self.max_id_map_pages):
+            url = f"{self.__base_url}/collections/{collection_id}?pageIndex={index}"
+            headers = {"Content-Type": "application/json"}
+            token = await self.token()
+            headers["Authorization"] = f"Bearer {token}"
+            try:
+                resp = await self.request("get", url, headers=headers)
+                if resp.status_code == 401:
+                    # unauthorized: check status endpoint and try refreshing token then retry once
+                    logger.warning("ID map fetch returned 401, checking auth status")
+                    self.expire_token(token)
+                    headers["Authorization"] = f"Bearer {await self.token()}"
+                    resp = await self.request("get", url, headers=headers)
                 if resp.status_code != 200:
                     logger.error(f"ID map fetch failed {resp.status_code}: {resp.text}")
-                    return
-            if resp.status_code != 200:
-                logger.error(f"ID map fetch failed {resp.status_code}: {resp.text}")
-                return
-            else:
-                logger.debug(f"ID map fetch succeeded: {resp.json()}")
-        except Exception as e:
-            logger.error(f"Error during ID map fetch request: {e}")
-
-        body = resp.json()
-        for entry in body.get("records", []):
-            pk_value = entry.get("data", {}).get(pk_field)
-            logger.info(f"Name: {pk_value} ID: {entry.get('id')}")
-            self._id_map[collection_id] = self._id_map.get(collection_id, {})
-            self._id_map[collection_id][pk_field] = self._id_map[collection_id].get(
-                pk_field, {}
-            )
-            self._id_map[collection_id][pk_field][pk_value] = entry.get("id")
+                    return False
+                else:
+                    logger.debug(f"ID map fetch succeeded: {resp.text}")
+            except Exception as e:
+                logger.error(f"Error during ID map fetch request: {e}")
+                return False
+
+            records = resp.json().get("records", [])
+            if len(records) == 0:
+                break
+
+            page_ids = {}
+            for entry in records:
+                pk_value = entry.get("data", {}).get(pk_field)
+                logger.debug(f"Name: {pk_value} ID: {entry.get('id')}")
+                page_ids[pk_value] = entry.get("id")
+            ids.update(page_ids)
+
+            if until is not None:
+                self.id_maps.merge(collection_id, pk_field, page_ids)
+                if until in page_ids:
+                    return True
+
+        # every page was read so this is the complete map
+        self.id_maps.replace(collection_id, pk_field, ids)
+        logger.info(f"Refreshed id map for {pk_field} in {collection_id}: {len(ids)} records")
+        return True
+
+
+def jwt_expiry(token):
+    """``exp`` claim of a JWT (seconds since the epoch), or None if it can't be read"""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except Exception:
+        return None
+
+
+class LastSentState:
+    """Per (collection, record id) snapshot of the field values last successfully sent to Kinabase.
+
+    Values are kept as their JSON encoding, which is compact and compares NaN and numpy scalars sensibly.
+    """
+
+    def __init__(self):
+        self.__sent = {}
+
+    def changed_fields(self, collection, record_id, data):
+        last = self.__sent.get((collection, record_id), {})
+        return {
+            field_name: value
+            for field_name, value in data.items()
+            if last.get(field_name) != json.dumps(value, default=_json_default)
+        }
+
+    def record_sent(self, collection, record_id, data):
+        last = self.__sent.setdefault((collection, record_id), {})
+        for field_name, value in data.items():
+            last[field_name] = json.dumps(value, default=_json_default)
+
+    def forget(self, collection, record_id):
+        self.__sent.pop((collection, record_id), None)
 
 
 class IDMap:
@@ -145,28 +336,60 @@ def write_history(
     app_id = kinabase_conf.get("app_id")
     secret = kinabase_conf.get("secret")
 
+    limits = {
+        "max_changes": int(kinabase_conf.get("ingest_max_changes", 500)),
+        "max_bytes": int(kinabase_conf.get("ingest_max_bytes", 1_000_000)),
+        "max_concurrency": int(kinabase_conf.get("ingest_max_concurrency", 4)),
+        "max_attempts": int(kinabase_conf.get("ingest_max_attempts", 3)),
+    }
+
     async def wrapped(data_frame):
         logger.info(f"data_frame: {data_frame}")
         kb = KBManager.get_inst(app_id, secret, base_url)
 
-        attempt_count = 0
-        while attempt_count < 2:
-            try:
-                _send_ingest(
-                    kb,
-                    base_url,
-                    kb.token,
-                    data_frame.to_dict(orient="records"),
-                    collection_id,
-                    fields,
-                    kb_pk_field,
-                    data_pk_field,
-                    timestamp_field,
+        outbox = KinabaseOutbox.get_inst()
+        if outbox.enabled:
+            if not collection_id:
+                logger.error("No collection_id configured, cannot upload")
+                return data_frame
+            grouped = _group_entries(data_frame.to_dict(orient="records"), data_pk_field)
+            queued = []
+            for data_pk, entries in grouped.items():
+                payload = {
+                    "app_id": app_id,
+                    "base_url": base_url,
+                    "collection": collection_id,
+                    "kb_pk_field": kb_pk_field,
+                    "data_pk": data_pk,
+                    "changes": _to_changes(entries, fields, timestamp_field),
+                    "limits": limits,
+                }
+                encoded = json.dumps(payload, default=_json_default, sort_keys=True)
+                # ingesting the same timestamped changes twice is redundant, so key on the content
+                queued.append(
+                    (
+                        _ordering_key(base_url, collection_id, kb_pk_field, data_pk),
+                        json.loads(encoded),
+                        hashlib.sha256(encoded.encode("utf-8")).hexdigest(),
+                    )
                 )
-                break
-            except TokenExpired:
-                kb.expire_token()
-                attempt_count += 1
+            # every record's changes in one transaction
+            outbox.enqueue_many("ingest", queued)
+            return data_frame
+
+        # a 401 refreshes the token and retries the chunk inside _send_record_set
+        await _send_ingest(
+            kb,
+            base_url,
+            await kb.token(),
+            data_frame.to_dict(orient="records"),
+            collection_id,
+            fields,
+            kb_pk_field,
+            data_pk_field,
+            timestamp_field,
+            **limits,
+        )
 
         return data_frame
 
@@ -188,16 +411,31 @@ def write_record(config, fields={}, pk_field="pk", collection_id=None):
     async def wrapped(record):
 
         kb = KBManager.get_inst(app_id, secret, base_url)
-        attempt_count = 0
-        while attempt_count < 2:
-            try:
-                _send_single(
-                    base_url, kb.token, record, collection_id, fields, pk_field
+
+        outbox = KinabaseOutbox.get_inst()
+        if outbox.enabled:
+            if record and collection_id:
+                outbox.enqueue(
+                    "create",
+                    _ordering_key(base_url, collection_id, pk_field, record.get(pk_field)),
+                    {
+                        "app_id": app_id,
+                        "base_url": base_url,
+                        "collection": collection_id,
+                        "fields": fields,
+                        "pk_field": pk_field,
+                        "record": record,
+                    },
+                    default=_json_default,
                 )
-                break
-            except TokenExpired:
-                kb.expire_token()
-                attempt_count += 1
+            elif not collection_id:
+                logger.error("No collection_id configured, cannot upload")
+            return record
+
+        await _with_token_retry(
+            kb,
+            lambda token: _send_single(kb, base_url, token, record, collection_id, fields, pk_field),
+        )
 
         return record
 
@@ -210,7 +448,15 @@ def update_record(
     kb_pk_field="pk",
     data_pk_field="machine",
     collection_id=None,
+    debounce_seconds=None,
 ):
+    """Only fields whose value differs from what was last sent for the record are PATCHed,
+    an update with no changes isn't sent at all.
+
+    With ``debounce_seconds`` (or kinabase.update_debounce_seconds) set, updates to the same
+    record within that window are merged (latest value of each field wins) and sent once
+    at the end of the window, the stage returns without waiting for the send.
+    """
     kinabase_conf = config["kinabase"]
     base_url = kinabase_conf.get("base_url", "https://app.kinabase.com/api/v1")
     collection_id = (
@@ -221,36 +467,75 @@ def update_record(
     # mapping from full topic to collection id, overrides default
     app_id = kinabase_conf.get("app_id")
     secret = kinabase_conf.get("secret")
+    if debounce_seconds is None:
+        debounce_seconds = kinabase_conf.get("update_debounce_seconds")
 
-    async def wrapped(record):
-        logger.info(f"record: {record}")
+    # data pk -> merged record waiting for the end of its debounce window
+    pending = {}
+    # tasks sending each pending record once its window ends
+    timers = set()
 
+    async def send(record):
         kb = KBManager.get_inst(app_id, secret, base_url)
 
-        attempt_count = 0
-        while attempt_count < 2:
-            try:
-                _update_single(
-                    kb,
-                    base_url,
-                    kb.token,
-                    record,
-                    collection_id,
-                    fields,
-                    kb_pk_field,
-                    data_pk_field,
+        outbox = KinabaseOutbox.get_inst()
+        if outbox.enabled:
+            if record and collection_id:
+                outbox.enqueue(
+                    "update",
+                    _ordering_key(base_url, collection_id, kb_pk_field, record[data_pk_field]),
+                    {
+                        "app_id": app_id,
+                        "base_url": base_url,
+                        "collection": collection_id,
+                        "fields": fields,
+                        "kb_pk_field": kb_pk_field,
+                        "data_pk_field": data_pk_field,
+                        "record": record,
+                    },
+                    default=_json_default,
                 )
-                break
-            except TokenExpired:
-                kb.expire_token()
-                attempt_count += 1
+            elif not collection_id:
+                logger.error("No collection_id configured, cannot upload")
+            return
+
+        await _with_token_retry(
+            kb,
+            lambda token: _update_single(
+                kb, base_url, token, record, collection_id, fields, kb_pk_field, data_pk_field
+            ),
+        )
+
+    async def send_after_window(data_pk):
+        await asyncio.sleep(debounce_seconds)
+        record = pending.pop(data_pk)
+        try:
+            await send(record)
+        except Exception:
+            logger.exception(f"Debounced update for {data_pk_field} {data_pk} failed")
+
+    async def wrapped(record):
+        logger.info(f"record: {record}")
+
+        if not debounce_seconds or not record:
+            await send(record)
+            return record
+
+        data_pk = record.get(data_pk_field)
+        if data_pk in pending:
+            pending[data_pk].update(record)
+        else:
+            pending[data_pk] = dict(record)
+            task = asyncio.create_task(send_after_window(data_pk))
+            timers.add(task)  # the loop only keeps a weak reference, so hold on to it until it's done
+            task.add_done_callback(timers.discard)
 
         return record
 
     return wrapped
 
 
-def _send_ingest(
+async def _send_ingest(
     kb: KBManager,
     base_url,
     token,
@@ -260,85 +545,162 @@ def _send_ingest(
     kb_pk_field,
     data_pk_field,
     timestamp_field="_time",
+    max_changes=500,
+    max_bytes=1_000_000,
+    max_concurrency=4,
+    max_attempts=3,
 ):
     """POST the provided list of record dicts to the ingest endpoint.
 
     ``collection_id`` may be provided per-call; if not, the default
     stored during initialization is used.
+
+    The changes are split into chunks of at most ``max_changes`` changes and roughly
+    ``max_bytes`` of JSON, sent with up to ``max_concurrency`` in flight. A chunk that
+    fails with 401, 429, 5xx or a network error is retried on its own (up to
+    ``max_attempts`` tries with exponential backoff), a 401 refreshes the token first.
+    Returns a metrics dict per chunk.
     """
     if not records:
-        return
+        return []
 
     if not cid:
         logger.error("No collection_id configured, cannot upload")
-        return
+        return []
+
+    record_set = await _to_records(
+        kb, records, fields, cid, kb_pk_field, data_pk_field, timestamp_field
+    )
+    return await _send_record_set(
+        kb, base_url, token, record_set, cid, max_changes, max_bytes, max_concurrency, max_attempts
+    )
+
 
+async def _send_record_set(
+    kb: KBManager,
+    base_url,
+    token,
+    record_set,
+    cid,
+    max_changes=500,
+    max_bytes=1_000_000,
+    max_concurrency=4,
+    max_attempts=3,
+    idempotency_key=None,
+):
     url = f"{base_url}/collections/{cid}/ingest"
-    headers = {"Content-Type": "application/json"}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
+    chunks = chunk_record_set(record_set, max_changes, max_bytes)
+    logger.info(f"url: {url} - {len(chunks)} chunk(s)")
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def send_chunk(index, chunk):
+        nonlocal token
+        payload = json.dumps(
+            {"mode": "FUTURE_FACING", "records": chunk}, default=_json_default
+        ).encode("utf-8")
+        metrics = {
+            "chunk": index,
+            "records": len(chunk),
+            "changes": sum(len(record["changes"]) for record in chunk),
+            "bytes": len(payload),
+            "attempts": 0,
+            "status": None,
+        }
+        start = time.perf_counter()
+        async with semaphore:
+            while metrics["attempts"] < max_attempts:
+                if metrics["attempts"] > 0:
+                    await asyncio.sleep(2 ** (metrics["attempts"] - 1))
+                metrics["attempts"] += 1
+                headers = {"Content-Type": "application/json"}
+                if token:
+                    headers["Authorization"] = f"Bearer {token}"
+                if idempotency_key:
+                    headers["Idempotency-Key"] = f"{idempotency_key}-{index}"
+                logger.debug(f"body: {payload}")
+                try:
+                    resp = await kb.request("post", url, headers=headers, data=payload)
+                    metrics["status"] = resp.status_code
+                except Exception as e:
+                    metrics["status"] = repr(e)
+                    logger.warning(f"Error during bulk upload request for chunk {index}: {e}")
+                    continue
+
+                if resp.status_code == 200:
+                    break
+                if resp.status_code == 401:
+                    logger.warning("Bulk upload returned 401, checking auth status")
+                    kb.expire_token(token)
+                    token = await kb.token()
+                    continue
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    logger.warning(f"Bulk upload of chunk {index} failed {resp.status_code}: {resp.text}")
+                    continue
+                logger.error(f"Bulk upload of chunk {index} rejected {resp.status_code}: {resp.text}")
+                break
 
-    body = {
-        "mode": "FUTURE_FACING",
-        "records": _to_records(
-            kb, records, fields, cid, kb_pk_field, data_pk_field, timestamp_field
-        ),
-    }
-    logger.info(f"url: {url}")
-    logger.info(f"body: {body}")
-    try:
-        resp = requests.post(url, headers=headers, json=body)
-        if resp.status_code == 401:
-            # unauthorized: check status endpoint and try refreshing token then retry once
-            logger.warning("Bulk upload returned 401, checking auth status")
-            raise TokenExpired()
-        if resp.status_code != 200:
-            logger.error(f"Bulk upload failed {resp.status_code}: {resp.text}")
+        metrics["seconds"] = time.perf_counter() - start
+        if metrics["status"] == 200:
+            logger.info(f"Bulk upload succeeded: {metrics}")
         else:
-            logger.info(f"Bulk upload succeeded: {resp.json()}")
-    except Exception as e:
-        logger.error(f"Error during bulk upload request: {e}")
-
+            logger.error(f"Bulk upload failed: {metrics}")
+        return metrics
 
-def get_id_for_pk(collection_id, base_url, token, pk_field, pk_value):
-    if collection_id is None:
-        logger.error("No collection_id configured, cannot refresh id map")
-        return
-    index = 0
-    found = False
-    while not found:
-        url = f"{base_url}/collections/{collection_id}?pageIndex={index}"
-        headers = {"Content-Type": "application/json"}
-        if token:
-            headers["Authorization"] = f"Bearer {token}"
-        try:
-            resp = requests.get(url, headers=headers)
-            if resp.status_code == 401:
-                # unauthorized: check status endpoint and try refreshing token then retry once
-                logger.warning("Bulk upload returned 401, checking auth status")
-                raise TokenExpired()
-            if resp.status_code != 200:
-                logger.error(f"Bulk upload failed {resp.status_code}: {resp.text}")
-            else:
-                logger.debug(f"Bulk upload succeeded: {resp.json()}")
-        except Exception as e:
-            logger.error(f"Error during bulk upload request: {e}")
+    return await asyncio.gather(
+        *[send_chunk(index, chunk) for index, chunk in enumerate(chunks)]
+    )
 
-        body = resp.json()
-        records = body.get("records", [])
-        if len(records) == 0:
-            logger.error(f"Could not find id for pk {pk_value} in field {pk_field}")
-            return None
 
-        for entry in records:
-            value = entry.get("data", {}).get(pk_field)
-            if value == pk_value:
-                return entry.get("id")
+def chunk_record_set(record_set, max_changes, max_bytes):
+    """Split ingest records into chunks bounded by change count and (approximate) JSON size.
 
-        index += 1
+    A record whose changes don't fit in one chunk is split across several, each carrying the record id.
+    """
+    chunks = []
+    current = []
+    current_changes = 0
+    current_bytes = 0
+    for record in record_set:
+        current_record = None
+        for change in record["changes"]:
+            change_bytes = len(json.dumps(change, default=_json_default)) + 1
+            if current_changes > 0 and (
+                current_changes + 1 > max_changes or current_bytes + change_bytes > max_bytes
+            ):
+                chunks.append(current)
+                current = []
+                current_changes = 0
+                current_bytes = 0
+                current_record = None
+            if current_record is None:
+                current_record = {"id": record["id"], "changes": []}
+                current.append(current_record)
+                current_bytes += len(json.dumps(record["id"])) + 20  # {"id":..,"changes":[]},
+            current_record["changes"].append(change)
+            current_changes += 1
+            current_bytes += change_bytes
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _json_default(value):
+    # numpy scalars from DataFrame.to_dict and pandas timestamps
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+async def get_id_for_pk(kb: KBManager, collection_id, pk_field, pk_value):
+    id = await kb.lookup_id(collection_id, pk_field, pk_value)
+    if id is None:
+        logger.error(f"Could not find id for pk {pk_value} in field {pk_field}")
+    return id
 
 
-def _to_records(
+async def _to_records(
     kb: KBManager,
     entries,
     fields,
@@ -348,48 +710,52 @@ def _to_records(
     timestamp_field,
 ):
     # group entries by machine name, then create a record set per machine
-    grouped_entries = {}
-    for entry in entries:
-        data_pk = entry.get(data_pk_field)
-        if data_pk not in grouped_entries:
-            grouped_entries[data_pk] = []
-        grouped_entries[data_pk].append(entry)
+    grouped_entries = _group_entries(entries, data_pk_field)
 
     record_set = []
 
     for data_pk, entries in grouped_entries.items():
         logger.debug(f"{data_pk_field}: {data_pk}")
-        id = kb.id_map(collection, kb_pk_field).get(data_pk)
+        id = await kb.lookup_id(collection, kb_pk_field, data_pk)
         if not id:
-            kb.refresh_id_map(collection, kb_pk_field)
-            id = kb.id_map(collection, kb_pk_field).get(data_pk)
-            if not id:
-                logger.error(f"No pk found for {data_pk_field} {data_pk}")
-                continue
+            logger.error(f"No pk found for {data_pk_field} {data_pk}")
+            continue
 
         record_set.append(
-            {
-                "id": id,
-                "changes": [
-                    {
-                        "timestamp": entry.get(timestamp_field)
-                        .to_pydatetime()
-                        .isoformat(),
-                        "data": {  # group by timestamp across machine
-                            field_name: entry.get(field_key)
-                            for field_name, field_key in fields.items()
-                            if entry.get(field_key) is not None
-                        },
-                    }
-                    for entry in entries
-                ],
-            }
+            {"id": id, "changes": _to_changes(entries, fields, timestamp_field)}
         )
 
     return record_set
 
 
-def _send_single(base_url, token, record, cid, fields, pk_field):
+def _group_entries(entries, data_pk_field):
+    grouped_entries = {}
+    for entry in entries:
+        data_pk = entry.get(data_pk_field)
+        if data_pk not in grouped_entries:
+            grouped_entries[data_pk] = []
+        grouped_entries[data_pk].append(entry)
+    return grouped_entries
+
+
+def _to_changes(entries, fields, timestamp_field):
+    return [
+        {
+            "timestamp": entry.get(timestamp_field).to_pydatetime().isoformat(),
+            "data": {  # group by timestamp across machine
+                field_name: entry.get(field_key)
+                for field_name, field_key in fields.items()
+                if entry.get(field_key) is not None
+            },
+        }
+        for entry in entries
+    ]
+
+
+async def _send_single(
+    kb: KBManager, base_url, token, record, cid, fields, pk_field, idempotency_key=None
+):
+    """Returns the response status, or None if the request couldn't be made"""
     if not record:
         return
 
@@ -401,6 +767,8 @@ def _send_single(base_url, token, record, cid, fields, pk_field):
     headers = {"Content-Type": "application/json"}
     if token:
         headers["Authorization"] = f"Bearer {token}"
+    if idempotency_key:
+        headers["Idempotency-Key"] = idempotency_key
 
     body = {
         "id": None,
@@ -416,7 +784,12 @@ def _send_single(base_url, token, record, cid, fields, pk_field):
     logger.info(f"url: {url}")
     logger.info(f"body: {body}")
     try:
-        resp = requests.post(url, headers=headers, json=body)
+        resp = await kb.request(
+            "post",
+            url,
+            headers=headers,
+            data=json.dumps(body, default=_json_default).encode("utf-8"),
+        )
         if resp.status_code == 401:
             # unauthorized: check status endpoint and try refreshing token then retry once
             logger.warning("upload returned 401, checking auth status")
@@ -427,13 +800,26 @@ def _send_single(base_url, token, record, cid, fields, pk_field):
             result = resp.json()
             IDMap.get_inst(pk_field).add(record, result)
             logger.info(f"upload succeeded: {result}")
+        return resp.status_code
+    except TokenExpired:
+        raise
     except Exception as e:
         logger.error(f"Error during upload request: {e}")
 
 
-def _update_single(
-    kb: KBManager, base_url, token, record, cid, fields, kb_pk_field, data_pk_field
+async def _update_single(
+    kb: KBManager,
+    base_url,
+    token,
+    record,
+    cid,
+    fields,
+    kb_pk_field,
+    data_pk_field,
+    idempotency_key=None,
 ):
+    """Returns the response status (200 if there was nothing to update), or None if the
+    request couldn't be made or the record's id couldn't be found"""
     if not record:
         return
 
@@ -441,27 +827,33 @@ def _update_single(
         logger.error("No collection_id configured, cannot upload")
         return
 
-    id = kb.id_map(cid, kb_pk_field).get(record[data_pk_field])
+    id = await kb.lookup_id(cid, kb_pk_field, record[data_pk_field])
     if id is None:
-        kb.refresh_id_map(cid,kb_pk_field)
-        id = kb.id_map(cid, kb_pk_field).get(record[data_pk_field])
-        if id is None:
-            logger.error(
-                f"Can't find matching ID for {data_pk_field} of {record[data_pk_field]} in {kb_pk_field} field of {cid} collection"
-            )
+        logger.error(
+            f"Can't find matching ID for {data_pk_field} of {record[data_pk_field]} in {kb_pk_field} field of {cid} collection"
+        )
+        return
 
     url = f"{base_url}/collections/{cid}/{id}"
     headers = {"Content-Type": "application/json"}
     if token:
         headers["Authorization"] = f"Bearer {token}"
+    if idempotency_key:
+        headers["Idempotency-Key"] = idempotency_key
+
+    data = {
+        field_name: record.get(field_key)
+        for field_name, field_key in fields.items()
+    }
+    changed = kb.last_sent.changed_fields(cid, id, data)
+    if not changed:
+        logger.debug(f"No changes for {data_pk_field} {record[data_pk_field]}, skipping update")
+        return 200
 
     body = {
         "id": id,
         "numericId": id,
-        "data": {
-            field_name: record.get(field_key)
-            for field_name, field_key in fields.items()
-        },
+        "data": changed,
         "external": None,
         "lists": None,
         "fileStorage": None,
@@ -469,7 +861,12 @@ def _update_single(
     logger.info(f"url: {url}")
     logger.info(f"body: {body}")
     try:
-        resp = requests.patch(url, headers=headers, json=body)
+        resp = await kb.request(
+            "patch",
+            url,
+            headers=headers,
+            data=json.dumps(body, default=_json_default).encode("utf-8"),
+        )
         if resp.status_code == 401:
             # unauthorized: check status endpoint and try refreshing token then retry once
             logger.warning("Bulk upload returned 401, checking auth status")
@@ -477,6 +874,101 @@ def _update_single(
         if resp.status_code != 200:
             logger.error(f"Bulk upload failed {resp.status_code}: {resp.text}")
         else:
+            kb.last_sent.record_sent(cid, id, changed)
             logger.info(f"Bulk upload succeeded: {resp.json()}")
+        return resp.status_code
+    except TokenExpired:
+        raise
     except Exception as e:
         logger.error(f"Error during bulk upload request: {e}")
+
+
+def _ordering_key(base_url, collection, pk_field, pk_value):
+    # queued writes to the same Kinabase record are delivered in order
+    return json.dumps([base_url, collection, pk_field, pk_value], default=_json_default)
+
+
+def _is_retryable(status):
+    return status is None or not isinstance(status, int) or status in (401, 429) or status >= 500
+
+
+async def _with_token_retry(kb: KBManager, send):
+    attempt_count = 0
+    while True:
+        token = await kb.token()
+        try:
+            return await send(token)
+        except TokenExpired:
+            kb.expire_token(token)
+            attempt_count += 1
+            if attempt_count >= 2:
+                return 401
+
+
+async def _resolve_id(kb: KBManager, cid, pk_field, value):
+    id = await kb.lookup_id(cid, pk_field, value)
+    if id is None:
+        # with an up to date id map the record really doesn't exist, otherwise Kinabase
+        # may just be unreachable - try again later
+        raise DeliveryFailed(
+            f"No id found for {pk_field} {value} in {cid}",
+            retry=kb.id_maps.is_stale(cid, pk_field),
+        )
+    return id
+
+
+def _check_status(status, description):
+    if status != 200:
+        raise DeliveryFailed(f"{description} returned {status}", retry=_is_retryable(status))
+
+
+@KinabaseOutbox.handler("ingest")
+async def _deliver_ingest(payload, idempotency_key):
+    kb = KBManager.for_app(payload["app_id"], payload["base_url"])
+    cid = payload["collection"]
+    id = await _resolve_id(kb, cid, payload["kb_pk_field"], payload["data_pk"])
+
+    record_set = [{"id": id, "changes": payload["changes"]}]
+
+    async def send(token):
+        metrics = await _send_record_set(
+            kb, payload["base_url"], token, record_set, cid, **payload["limits"],
+            idempotency_key=idempotency_key,
+        )
+        failed = [chunk["status"] for chunk in metrics if chunk["status"] != 200]
+        if not failed:
+            return 200
+        # resending chunks that did succeed is harmless - changes are keyed on timestamp
+        return next((status for status in failed if _is_retryable(status)), failed[0])
+
+    _check_status(await _with_token_retry(kb, send), "Ingest")
+
+
+@KinabaseOutbox.handler("create")
+async def _deliver_create(payload, idempotency_key):
+    kb = KBManager.for_app(payload["app_id"], payload["base_url"])
+    status = await _with_token_retry(
+        kb,
+        lambda token: _send_single(
+            kb, payload["base_url"], token, payload["record"], payload["collection"],
+            payload["fields"], payload["pk_field"], idempotency_key=idempotency_key,
+        ),
+    )
+    _check_status(status, "Create")
+
+
+@KinabaseOutbox.handler("update")
+async def _deliver_update(payload, idempotency_key):
+    kb = KBManager.for_app(payload["app_id"], payload["base_url"])
+    await _resolve_id(
+        kb, payload["collection"], payload["kb_pk_field"], payload["record"][payload["data_pk_field"]]
+    )
+    status = await _with_token_retry(
+        kb,
+        lambda token: _update_single(
+            kb, payload["base_url"], token, payload["record"], payload["collection"],
+            payload["fields"], payload["kb_pk_field"], payload["data_pk_field"],
+            idempotency_key=idempotency_key,
+        ),
+    )
+    _check_status(status, "Update")
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class IdMapStore:
+    """Kinabase record ids indexed by (collection, pk_field, pk value), persisted to a JSON file.
+
+    Each (collection, pk_field) map remembers when it was last fully fetched so callers
+    can tell when it is stale. Values that weren't found are remembered for
+    ``negative_ttl`` seconds so an unknown machine doesn't trigger a fetch every time.
+    """
+
+    def __init__(self, path, namespace, ttl=3600, negative_ttl=600):
+        self.path = path
+        self.namespace = namespace  # e.g. base url, so several Kinabase instances can share the file
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.__maps = {}
+        self.__missing = {}
+        self.load()
+
+    def get(self, collection, pk_field, value):
+        entry = self.__maps.get((collection, pk_field))
+        if entry is None:
+            return None
+        return entry["ids"].get(value)
+
+    def has_map(self, collection, pk_field):
+        return (collection, pk_field) in self.__maps
+
+    def ids(self, collection, pk_field):
+        entry = self.__maps.get((collection, pk_field))
+        return entry["ids"] if entry is not None else {}
+
+    def is_stale(self, collection, pk_field):
+        entry = self.__maps.get((collection, pk_field))
+        return entry is None or time.time() - entry["fetched_at"] > self.ttl
+
+    def fetched_within(self, collection, pk_field, seconds):
+        entry = self.__maps.get((collection, pk_field))
+        return entry is not None and time.time() - entry["fetched_at"] <= seconds
+
+    def merge(self, collection, pk_field, ids):
+        """Add ids from a partial fetch without changing when the map was last fully fetched"""
+        entry = self.__maps.setdefault((collection, pk_field), {"fetched_at": 0, "ids": {}})
+        entry["ids"].update(ids)
+        for value in ids:
+            self.__missing.pop((collection, pk_field, value), None)
+
+    def replace(self, collection, pk_field, ids):
+        self.__maps[(collection, pk_field)] = {"fetched_at": time.time(), "ids": dict(ids)}
+        for value in ids:
+            self.__missing.pop((collection, pk_field, value), None)
+        self.save()
+
+    def mark_missing(self, collection, pk_field, value):
+        self.__missing[(collection, pk_field, value)] = time.time() + self.negative_ttl
+
+    def is_known_missing(self, collection, pk_field, value):
+        expiry = self.__missing.get((collection, pk_field, value))
+        if expiry is None:
+            return False
+        if time.time() > expiry:
+            del self.__missing[(collection, pk_field, value)]
+            return False
+        return True
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Unable to load Kinabase id map cache from {self.path}: {e}")
+            return
+
+        for entry in stored.get(self.namespace, []):
+            # ids are stored as [value, id] pairs so non-string pk values keep their type
+            self.__maps[(entry["collection"], entry["pk_field"])] = {
+                "fetched_at": entry["fetched_at"],
+                "ids": {value: id for value, id in entry["ids"]},
+            }
+        logger.info(f"Loaded {len(self.__maps)} Kinabase id map(s) from {self.path}")
+
+    def save(self):
+        try:
+            try:
+                with open(self.path, "r") as f:
+                    stored = json.load(f)
+            except (FileNotFoundError, ValueError):
+                stored = {}
+            stored[self.namespace] = [
+                {
+                    "collection": collection,
+                    "pk_field": pk_field,
+                    "fetched_at": entry["fetched_at"],
+                    "ids": list(entry["ids"].items()),
+                }
+                for (collection, pk_field), entry in self.__maps.items()
+            ]
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(stored, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logger.error(f"Unable to save Kinabase id map cache to {self.path}: {e}")
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from config_manager import is_true
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryFailed(Exception):
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+
+class KinabaseOutbox:
+    """Durable queue that Kinabase writes go through, stored in SQLite next to the scheduler's jobs.sqlite.
+
+    Producers ``enqueue`` a write and carry on; ``run`` delivers queued writes in the
+    background using the handler registered for their kind. Entries that share an
+    ``ordering_key`` (i.e. the same Kinabase record) are delivered strictly in the order
+    they were queued, entries for different records are delivered concurrently.
+    A handler raising ``DeliveryFailed(retry=True)`` (or any other exception) is retried
+    with exponential backoff from ``retry_seconds`` up to ``max_retry_seconds``, holding
+    back later writes to the same record. ``DeliveryFailed(retry=False)`` drops the entry,
+    as does still being undelivered after ``max_age_seconds``.
+
+    Each entry has an idempotency key that stays the same across retries. Passing the same
+    key twice while the first is still queued only queues it once.
+    """
+
+    inst = None
+    handlers = {}
+
+    @classmethod
+    def get_inst(cls) -> "KinabaseOutbox":
+        if cls.inst is None:
+            cls.inst = cls()
+        return cls.inst
+
+    @classmethod
+    def handler(cls, kind):
+        def register(func):
+            cls.handlers[kind] = func
+            return func
+
+        return register
+
+    def __init__(self):
+        self.enabled = True
+        self.path = "/app/data/kinabase_outbox.sqlite"
+        self.max_concurrency = 4
+        self.retry_seconds = 5
+        self.max_retry_seconds = 300
+        self.max_age_seconds = 7 * 24 * 3600
+
+        self.__db = None
+        self.__wakeup = None
+
+        self.delivered = 0
+        self.retries = 0
+        self.dropped = 0
+
+    def configure(self, kinabase_config):
+        self.enabled = is_true(kinabase_config.get("outbox_enabled", self.enabled)) and bool(kinabase_config)
+        self.path = kinabase_config.get("outbox_path", self.path)
+        self.max_concurrency = int(kinabase_config.get("outbox_max_concurrency", self.max_concurrency))
+        self.retry_seconds = float(kinabase_config.get("outbox_retry_seconds", self.retry_seconds))
+        self.max_retry_seconds = float(kinabase_config.get("outbox_max_retry_seconds", self.max_retry_seconds))
+        self.max_age_seconds = float(kinabase_config.get("outbox_max_age_seconds", self.max_age_seconds))
+
+    def db(self) -> sqlite3.Connection:
+        if self.__db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.__db = sqlite3.connect(self.path, isolation_level=None)
+            self.__db.row_factory = sqlite3.Row
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute(
+                """CREATE TABLE IF NOT EXISTS outbox (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT NOT NULL UNIQUE,
+                    kind TEXT NOT NULL,
+                    ordering_key TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT
+                )"""
+            )
+            self.__db.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_ordering ON outbox (ordering_key, seq)"
+            )
+        return self.__db
+
+    def enqueue(self, kind, ordering_key, payload, idempotency_key=None, default=None):
+        """Queue a write, returns its idempotency key. ``payload`` is stored as JSON (``default`` as for json.dumps)."""
+        return self.enqueue_many(kind, [(ordering_key, payload, idempotency_key)], default=default)[0]
+
+    def enqueue_many(self, kind, entries, default=None):
+        """Queue several writes of one kind in a single transaction (one commit on the event loop
+        rather than one per write). ``entries`` are (ordering_key, payload, idempotency_key or
+        None) tuples, returns their idempotency keys in the same order."""
+        now = time.time()
+        rows = []
+        for ordering_key, payload, idempotency_key in entries:
+            if idempotency_key is None:
+                idempotency_key = uuid.uuid4().hex
+            rows.append((idempotency_key, kind, ordering_key, json.dumps(payload, default=default), now, now))
+        if not rows:
+            return []
+
+        db = self.db()
+        db.execute("BEGIN")
+        try:
+            db.executemany(
+                "INSERT OR IGNORE INTO outbox (idempotency_key, kind, ordering_key, payload, created_at, next_attempt_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+        return [row[0] for row in rows]
+
+    def due(self, limit, exclude=()):
+        # only the oldest entry of each record, so a record's writes can't overtake each other
+        return self.db().execute(
+            "SELECT * FROM outbox WHERE seq IN (SELECT MIN(seq) FROM outbox GROUP BY ordering_key)"
+            f" AND ordering_key NOT IN ({', '.join('?' * len(exclude))})"
+            " AND next_attempt_at <= ? ORDER BY seq LIMIT ?",
+            (*exclude, time.time(), limit),
+        ).fetchall()
+
+    def next_attempt_at(self, exclude=()):
+        row = self.db().execute(
+            "SELECT MIN(next_attempt_at) FROM outbox WHERE seq IN (SELECT MIN(seq) FROM outbox GROUP BY ordering_key)"
+            f" AND ordering_key NOT IN ({', '.join('?' * len(exclude))})",
+            tuple(exclude),
+        ).fetchone()
+        return row[0]
+
+    def stats(self):
+        row = self.db().execute(
+            "SELECT COUNT(*), MIN(created_at), SUM(attempts > 0) FROM outbox"
+        ).fetchone()
+        depth, oldest, retrying = row
+        return {
+            "depth": depth,
+            "oldest_seconds": time.time() - oldest if oldest is not None else None,
+            "retrying": retrying or 0,
+            "delivered": self.delivered,
+            "retries": self.retries,
+            "dropped": self.dropped,
+        }
+
+    async def run(self):
+        if not self.enabled:
+            if os.path.exists(self.path):
+                logger.warning(f"Kinabase outbox is disabled, writes queued in {self.path} won't be delivered")
+            return
+
+        self.__wakeup = asyncio.Event()
+        depth = self.stats()["depth"]
+        if depth:
+            logger.info(f"{depth} queued Kinabase write(s) from a previous run")
+
+        # ordering_key -> task delivering that record's oldest entry, refilled as each one finishes
+        delivering = {}
+        try:
+            while True:
+                free = self.max_concurrency - len(delivering)
+                if free > 0:
+                    for entry in self.due(free, exclude=delivering.keys()):
+                        task = asyncio.create_task(self.__deliver(entry))
+                        delivering[entry["ordering_key"]] = task
+                        task.add_done_callback(
+                            lambda _task, ordering_key=entry["ordering_key"]: self.__delivered(delivering, ordering_key)
+                        )
+
+                next_attempt = self.next_attempt_at(exclude=delivering.keys())
+                timeout = self.retry_seconds if next_attempt is None else max(0, next_attempt - time.time())
+                if len(delivering) >= self.max_concurrency:
+                    timeout = None  # nothing more can start until a delivery finishes
+                try:
+                    await asyncio.wait_for(self.__wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.__wakeup.clear()
+        finally:
+            for task in list(delivering.values()):
+                task.cancel()
+
+    def __delivered(self, delivering, ordering_key):
+        delivering.pop(ordering_key, None)
+        self.__wakeup.set()
+
+    async def close(self):
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+    async def __deliver(self, entry):
+        handler = self.handlers.get(entry["kind"])
+        try:
+            if handler is None:
+                raise DeliveryFailed(f"No handler for {entry['kind']} writes", retry=False)
+            await handler(json.loads(entry["payload"]), entry["idempotency_key"])
+        except Exception as e:
+            retry = e.retry if isinstance(e, DeliveryFailed) else True
+            if retry and time.time() - entry["created_at"] < self.max_age_seconds:
+                delay = min(self.max_retry_seconds, self.retry_seconds * 2 ** entry["attempts"])
+                self.db().execute(
+                    "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE seq = ?",
+                    (time.time() + delay, str(e), entry["seq"]),
+                )
+                self.retries += 1
+                logger.warning(
+                    f"Kinabase {entry['kind']} write for {entry['ordering_key']} failed (attempt {entry['attempts'] + 1}),"
+                    f" retrying in {delay:.0f}s - {self.stats()['depth']} write(s) queued: {e}"
+                )
+                return
+            logger.error(
+                f"Dropping Kinabase {entry['kind']} write for {entry['ordering_key']} after {entry['attempts'] + 1} attempt(s): {e}"
+            )
+            self.dropped += 1
+        else:
+            self.delivered += 1
+        self.db().execute("DELETE FROM outbox WHERE seq = ?", (entry["seq"],))
@@ -1,20 +1,114 @@
 from typing import Self, Tuple
+import asyncio
+import copy
+from collections.abc import AsyncIterable
+import logging
+import pandas
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
 
 class Pipeline:
-    def __init__(self,result):
+    def __init__(self, result, name="pipeline", profile=False):
         self.__result = result
+        self.name = name
+        self.profile = profile
 
     async def next(self, func):
-        next_result = await func(self.__result)
+        with instrumentation.StageTimer(
+            self.name, instrumentation.stage_name(func), self.__result, profile=self.profile
+        ) as timer:
+            next_result = await func(self.__result)
+            timer.data_out = next_result
         self.__result = next_result
 
     @classmethod
-    def start(cls, initial_data={}) -> Self:
-        return cls(initial_data)
+    def start(cls, initial_data={}, name="pipeline") -> Self:
+        """``name`` labels the stage stats reported to the instrumentation sinks"""
+        return cls(initial_data, name, profile=instrumentation.claim_profile_request())
 
     @property
     def result(self):
         return self.__result
 
     def split(self) -> Tuple[Self,Self]:
-        return Pipeline(self.__result), Pipeline(self.__result)
+        """Two pipelines that carry on from the current result, the second takes the result
+        itself and the first a copy (see branch_copy) - don't carry on with this pipeline."""
+        return (
+            Pipeline(branch_copy(self.__result), self.name, self.profile),
+            Pipeline(branch_check(self.__result), self.name, self.profile),
+        )
+
+    async def fork(self, *branches):
+        """Run each branch concurrently on its own copy of the current result (the last
+        branch takes the result itself, as nothing else uses it once the branches start).
+
+        A branch is an async function that takes a Pipeline, e.g.
+        ``async def to_kinabase(pipeline): await pipeline.next(write_history(config))``.
+        A failing branch is logged and does not cancel the others. Returns a list
+        (in branch order) of each branch's final result, or the exception it raised.
+        Branch timing is reported to the instrumentation sinks as stage "branch:<name>".
+        """
+
+        async def run_branch(branch, data):
+            name = getattr(branch, "__name__", repr(branch))
+            pipeline = Pipeline(data, f"{self.name}/{name}", self.profile)
+            with instrumentation.StageTimer(self.name, f"branch:{name}", self.__result) as timer:
+                try:
+                    await branch(pipeline)
+                except Exception:
+                    logger.exception(f"Pipeline branch {name} failed")
+                    raise
+                timer.data_out = pipeline.result
+            return pipeline.result
+
+        # copied up front so a result that can't be copied fails the fork rather than each branch
+        copies = [branch_copy(self.__result) for _ in branches[1:]] + [branch_check(self.__result)]
+        return await asyncio.gather(
+            *[run_branch(branch, data) for branch, data in zip(branches, copies)], return_exceptions=True
+        )
+
+
+def per_chunk(func):
+    """Apply a DataFrame stage to each chunk of a streamed result as it is consumed.
+
+    e.g. ``await pipeline.next(per_chunk(calculate_power(config)))`` after a stream query.
+    A non-streamed result is passed straight to func.
+    """
+
+    async def wrapped(data):
+        if not isinstance(data, AsyncIterable):
+            return await func(data)
+
+        async def chunks():
+            async for chunk in data:
+                yield await func(chunk)
+
+        return chunks()
+
+    wrapped.__qualname__ = f"per_chunk({instrumentation.stage_name(func)})"
+    return wrapped
+
+
+def branch_check(data):
+    # a stream (e.g. from do_stream_query) can only be read once so can't be shared between branches
+    if isinstance(data, AsyncIterable):
+        raise Exception(
+            "Can't split or fork a pipeline while its result is a stream of chunks, it can only be read once"
+            " - use do_query instead of do_stream_query or run a separate query in each branch"
+        )
+    return data
+
+
+def branch_copy(data):
+    """Copy data so that one branch mutating it in place can't affect another.
+
+    With pandas copy-on-write enabled (the TriggerEngine turns it on unless the
+    pandas_copy_on_write setting is false) DataFrames are copied lazily - only the
+    columns a branch writes to are duplicated - otherwise a deep copy is made.
+    """
+    branch_check(data)
+    if isinstance(data, (pandas.DataFrame, pandas.Series)):
+        return data.copy(deep=pandas.options.mode.copy_on_write is not True)
+    return copy.deepcopy(data)
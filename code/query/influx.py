@@ -3,12 +3,15 @@ import re
 import datetime
 import logging
 import asyncio
-from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+from pandas import DataFrame, concat
+from influx_pool import InfluxClientPool
+from .result_cache import QueryResultCache
 
 
 logger = logging.getLogger(__name__)
 
-def per_phase_current(config,dt_from,dt_to,t_window="5s"):
+def per_phase_current(config,dt_from,dt_to,t_window="5s",slice_span=None,cached=False):
+    """cached=True serves already closed windows from the query result cache"""
     query = """
     from(bucket: _bucket)
         |> range(start: _start, stop: _stop)
@@ -18,11 +21,16 @@ def per_phase_current(config,dt_from,dt_to,t_window="5s"):
         |> pivot(columnKey: ["phase"], rowKey: ["_time"], valueColumn: "_value")
         |> keep(columns:["_time","machine","A","B","C","single"])
     """
-    return do_query(
+    return do_windowed_query(
         config["influx"]["url"],
         config["influx"]["token"],
         config["influx"]["org"],
         query,
+        window=Interval(t_window).timedelta,
+        slice_span=Interval(slice_span).timedelta if slice_span else None,
+        max_concurrency=config["influx"].get("max_slice_concurrency", 4),
+        order_by=["machine"],
+        cache_settle=cache_settle_time(config) if cached else None,
         _bucket=config["influx"].get("bucket"),
         _start=dt_from,
         _stop=dt_to,
@@ -30,7 +38,9 @@ def per_phase_current(config,dt_from,dt_to,t_window="5s"):
     )
 
 
-def current_and_voltage(config, dt_from ,dt_to, t_window="5s"):
+def current_and_voltage(config, dt_from ,dt_to, t_window="5s", slice_span=None, cached=False):
+    """slice_span (e.g. "1d") opts in to running the query as parallel time slices,
+    cached=True serves already closed windows from the query result cache"""
     query = """
             from(bucket: _bucket)
                 |> range(start: _start, stop: _stop)
@@ -43,11 +53,16 @@ def current_and_voltage(config, dt_from ,dt_to, t_window="5s"):
                 |> pivot(columnKey: ["_field"], rowKey: ["_time"], valueColumn: "_value")
             """
 
-    return do_query(
+    return do_windowed_query(
         config["influx"]["url"],
         config["influx"]["token"],
         config["influx"]["org"],
         query,
+        window=Interval(t_window).timedelta,
+        slice_span=Interval(slice_span).timedelta if slice_span else None,
+        max_concurrency=config["influx"].get("max_slice_concurrency", 4),
+        order_by=["machine"],
+        cache_settle=cache_settle_time(config) if cached else None,
         _bucket=config["influx"].get("bucket"),
         _start=dt_from,
         _stop=dt_to,
@@ -84,7 +99,9 @@ def latest_current_and_voltage(config, dt_to,machine,t_window="5s"):
     )
 
 
-def real_power(config, dt_from, dt_to):
+def real_power(config, dt_from, dt_to, stream=False, chunk_rows=10000):
+    """stream=True returns an async iterator of DataFrames of up to chunk_rows rows
+    instead of a single DataFrame, so memory stays bounded for long raw ranges"""
     query = """
             from(bucket: _bucket)
                 |> range(start: _start, stop: _stop)
@@ -94,6 +111,18 @@ def real_power(config, dt_from, dt_to):
                 |> pivot(columnKey: ["_field"], rowKey: ["_time"], valueColumn: "_value")
             """
 
+    if stream:
+        return do_stream_query(
+            config["influx"]["url"],
+            config["influx"]["token"],
+            config["influx"]["org"],
+            query,
+            chunk_rows=chunk_rows,
+            _bucket = config["influx"].get("bucket"),
+            _start = dt_from,
+            _stop = dt_to,
+        )
+
     return do_query(
         config["influx"]["url"],
         config["influx"]["token"],
@@ -104,7 +133,8 @@ def real_power(config, dt_from, dt_to):
         _stop = dt_to,
     )
 
-def energy(config, dt_from,dt_to,window,machine):
+def energy(config, dt_from,dt_to,window,machine,slice_span=None):
+    """slice_span (e.g. "7d") opts in to running the query as parallel time slices"""
     query = f"""
             from(bucket: _bucket)
                 |> range(start: _start, stop: _stop)
@@ -115,11 +145,14 @@ def energy(config, dt_from,dt_to,window,machine):
                 |> pivot(columnKey: ["_field"], rowKey: ["_time"], valueColumn: "_value")
                 |> aggregateWindow(every: _window, fn: sum, createEmpty: true, timeSrc:"_start", column: "energy")
             """
-    return do_query(
+    return do_windowed_query(
         config["influx"]["url"],
         config["influx"]["token"],
         config["influx"]["org"],
         query,
+        window=Interval(window).timedelta,
+        slice_span=Interval(slice_span).timedelta if slice_span else None,
+        max_concurrency=config["influx"].get("max_slice_concurrency", 4),
         _bucket=config["influx"].get("bucket"),
         _start=dt_from,
         _stop=dt_to,
@@ -130,26 +163,343 @@ def energy(config, dt_from,dt_to,window,machine):
 
 def do_query(url, token, org, query, **params):
     async def wrapped(data):
-        attempt_count = 1
-        while True:
-            try:
-                async with InfluxDBClientAsync(url=url, token=token, org=org, timeout=60000) as client:
-                    query_api = client.query_api()
-                    data_frame = await query_api.query_data_frame(
-                        query, params=params
-                    )
-
-                return data_frame
-            except asyncio.TimeoutError:
-                attempt_count += 1
-                if attempt_count <= 3:
-                    logger.warning(f"Retrying due to timeout during influx query - attempt {attempt_count}")
-                else:
-                    raise
+        return await _query_data_frame(url, token, org, query, params)
+
+    return wrapped
+
+
+def do_stream_query(url, token, org, query, chunk_rows=10000, **params):
+    """Like do_query but the stage returns an async iterator of DataFrame chunks.
+
+    Rows are parsed from the response as they arrive and yielded in chunks of at
+    most ``chunk_rows``. A pooled streaming client is held until the iterator is exhausted
+    or closed (streams have their own clients so this can't block other queries or
+    writes), and the client timeout (influx.timeout_ms) covers the whole response.
+    The stream can only be read once, so the pipeline can't be split or forked while
+    its result is a stream.
+    """
+
+    async def wrapped(data):
+        return _stream_data_frames(url, token, org, query, params, chunk_rows)
 
     return wrapped
 
 
+async def _stream_data_frames(url, token, org, query, params, chunk_rows):
+    attempt_count = 1
+    chunks_sent = 0
+    while True:
+        try:
+            async with InfluxClientPool.get_inst().client(url, token, org, stream=True) as client:
+                records = await client.query_api().query_stream(query, params=params)
+                rows = []
+                async for record in records:
+                    rows.append(record.values)
+                    if len(rows) >= chunk_rows:
+                        chunks_sent += 1
+                        yield DataFrame(rows)
+                        rows = []
+                if rows:
+                    chunks_sent += 1
+                    yield DataFrame(rows)
+            return
+        except asyncio.TimeoutError:
+            attempt_count += 1
+            if attempt_count <= 3 and chunks_sent == 0:  # can only retry before anything was passed on
+                logger.warning(f"Retrying due to timeout during influx query - attempt {attempt_count}")
+            else:
+                raise
+
+
+def do_windowed_query(
+    url,
+    token,
+    org,
+    query,
+    *,
+    window,
+    slice_span=None,
+    max_concurrency=4,
+    order_by=None,
+    cache_settle=None,
+    **params,
+):
+    """Run an aggregateWindow query, optionally split into time slices and/or cached.
+
+    With ``slice_span`` set, ``[_start, _stop)`` is split into sub-ranges whose inner
+    boundaries fall on ``window`` boundaries (aggregateWindow aligns windows to the
+    epoch) so every window is computed from exactly the same data as a single query.
+    At most ``max_concurrency`` slices are in flight at once and the resulting frames
+    are concatenated in time order, then stably sorted on ``order_by`` (if given) to
+    match the table order of the single query.
+
+    With ``cache_settle`` set, windows that closed more than ``cache_settle`` ago are
+    kept in the QueryResultCache and a repeat request only fetches the open tail
+    (plus the partial first window if ``_start`` is not window aligned).
+
+    ``_start``/``_stop`` given relative to now (timedeltas) are resolved to UTC times
+    each time the stage runs.
+    """
+    if slice_span is None and cache_settle is None:
+        return do_query(url, token, org, query, **params)
+
+    async def fetch(start, stop):
+        if slice_span is None:
+            return await _query_data_frame(
+                url, token, org, query, {**params, "_start": start, "_stop": stop}
+            )
+
+        ranges = slice_range(start, stop, window, slice_span)
+        logger.debug(f"Running influx query as {len(ranges)} slices")
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_slice(slice_start, slice_stop):
+            async with semaphore:
+                return await _query_data_frame(
+                    url, token, org, query, {**params, "_start": slice_start, "_stop": slice_stop}
+                )
+
+        results = await asyncio.gather(
+            *[run_slice(slice_start, slice_stop) for slice_start, slice_stop in ranges]
+        )
+        return concat_frames(results, order_by)
+
+    async def wrapped(data):
+        # a relative range is fixed when the query runs so it can be sliced and aligned
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        start = resolve_time(params["_start"], now)
+        stop = resolve_time(params["_stop"], now)
+        if cache_settle is None:
+            return await fetch(start, stop)
+        return await _cached_fetch(
+            fetch,
+            query_key(url, token, org, query, params, exclude=("_start", "_stop")),
+            start,
+            stop,
+            window,
+            cache_settle,
+            order_by,
+        )
+
+    return wrapped
+
+
+async def _cached_fetch(fetch, key, start, stop, window, settle, order_by):
+    result_cache = QueryResultCache.get_inst()
+    # compared with the cached frames' _time, which influx returns in UTC
+    start = as_utc(start)
+    stop = as_utc(stop)
+
+    aligned_start = align_to_window(start, window)
+    if aligned_start < start:
+        aligned_start += window  # first window is partial so can't come from the cache
+    aligned_stop = align_to_window(stop, window)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    closed_until = align_to_window(min(stop, now - settle), window)
+
+    entry = result_cache.get(key)
+    if (
+        aligned_stop <= aligned_start
+        or entry is None
+        or not (entry["covered_from"] <= aligned_start < entry["covered_to"])
+    ):
+        result_cache.misses += 1
+        data_frame = concat_frames([await fetch(start, stop)], order_by)
+        if closed_until > aligned_start and "_time" in data_frame:
+            result_cache.put(
+                key,
+                rows_in_range(data_frame, aligned_start, closed_until),
+                aligned_start,
+                closed_until,
+            )
+        return data_frame
+
+    cached_until = min(entry["covered_to"], aligned_stop)
+    cached = rows_in_range(entry["frame"], aligned_start, cached_until)
+
+    head_range = (start, aligned_start) if start < aligned_start else None
+    tail_range = (cached_until, stop) if cached_until < stop else None
+    head, tail = await asyncio.gather(
+        *[
+            fetch(*fetch_range) if fetch_range else _no_result()
+            for fetch_range in (head_range, tail_range)
+        ]
+    )
+    head = concat_frames([head])
+    tail = concat_frames([tail])
+
+    if cached_until < stop:
+        result_cache.partial_hits += 1
+    else:
+        result_cache.hits += 1
+    logger.debug(f"Query cache served {len(cached)} rows, fetched {len(head)} head and {len(tail)} tail rows")
+
+    if (
+        cached_until == entry["covered_to"]
+        and closed_until > cached_until
+        and "_time" in tail
+    ):
+        result_cache.put(
+            key,
+            concat_frames(
+                [entry["frame"], rows_in_range(tail, cached_until, closed_until)],
+                order_by,
+            ),
+            entry["covered_from"],
+            closed_until,
+            fetched_at=entry["fetched_at"],  # extending the entry doesn't refresh the rows already in it
+        )
+
+    return concat_frames([head, cached, tail], order_by)
+
+
+async def _no_result():
+    return DataFrame()
+
+
+def rows_in_range(data_frame, start, stop):
+    if "_time" not in data_frame:
+        return data_frame.iloc[0:0]
+    return data_frame[(data_frame["_time"] >= start) & (data_frame["_time"] < stop)]
+
+
+def query_key(url, token, org, query, params, exclude=()):
+    """Hashable key for a query, parameters are normalised so equal values give equal keys"""
+    normalised = []
+    for name, value in sorted(params.items()):
+        if name in exclude:
+            continue
+        if isinstance(value, datetime.datetime):
+            value = value.astimezone(datetime.timezone.utc).isoformat() if value.tzinfo else value.isoformat()
+        elif isinstance(value, datetime.timedelta):
+            value = value.total_seconds()
+        else:
+            value = repr(value)
+        normalised.append((name, value))
+    return (url, token, org, " ".join(query.split()), tuple(normalised))
+
+
+def cache_settle_time(config):
+    # late points can still land in a window shortly after it ends
+    return Interval(config["influx"].get("cache_settle_time", "1m")).timedelta
+
+
+# identical queries currently being run, keyed on query_key - concurrent callers share one request
+_in_flight = {}
+
+
+async def _query_data_frame(url, token, org, query, params):
+    key = query_key(url, token, org, query, params)
+    shared = _in_flight.get(key)
+    if shared is None:
+        task = asyncio.ensure_future(_run_query(url, token, org, query, params))
+        shared = {"task": task, "waiting": 0}
+        _in_flight[key] = shared
+        task.add_done_callback(lambda done: _query_done(key, done))
+    else:
+        logger.debug("Joining identical in-flight influx query")
+
+    shared["waiting"] += 1
+    try:
+        # shielded so one caller being cancelled doesn't cancel the query for the others
+        result = await asyncio.shield(shared["task"])
+    finally:
+        shared["waiting"] -= 1
+    # _query_done runs before any caller resumes, so nobody can join once the first has.
+    # Stages mutate frames in place, so every caller but the last to resume gets its own
+    # copy - the last one takes the shared result as the others have copied it already
+    if shared["waiting"] == 0:
+        return result
+    if isinstance(result, list):
+        return [data_frame.copy() for data_frame in result]
+    return result.copy()
+
+
+def _query_done(key, task):
+    shared = _in_flight.get(key)
+    if shared is not None and shared["task"] is task:
+        del _in_flight[key]
+    if not task.cancelled():
+        task.exception()  # mark as retrieved in case every caller was cancelled
+
+
+async def _run_query(url, token, org, query, params):
+    attempt_count = 1
+    while True:
+        try:
+            async with InfluxClientPool.get_inst().client(url, token, org) as client:
+                query_api = client.query_api()
+                data_frame = await query_api.query_data_frame(
+                    query, params=params
+                )
+
+            return data_frame
+        except asyncio.TimeoutError:
+            attempt_count += 1
+            if attempt_count <= 3:
+                logger.warning(f"Retrying due to timeout during influx query - attempt {attempt_count}")
+            else:
+                raise
+
+
+def resolve_time(value, now):
+    """A range bound given relative to now (a timedelta, as influx accepts) as an absolute time"""
+    if isinstance(value, datetime.timedelta):
+        return now + value
+    return value
+
+
+def as_utc(timestamp: datetime.datetime):
+    """Aware UTC datetime, naive timestamps are taken to be UTC"""
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.astimezone(datetime.timezone.utc)
+
+
+def align_to_window(timestamp: datetime.datetime, window: datetime.timedelta):
+    """Round timestamp down to a window boundary, windows are aligned to the unix epoch in UTC
+    as influx's aggregateWindow does. Naive timestamps are taken to be UTC, aware ones are
+    returned in UTC so adding windows to the result doesn't shift across DST changes."""
+    if timestamp.tzinfo is None:
+        epoch = datetime.datetime(1970, 1, 1)
+        return timestamp - ((timestamp - epoch) % window)
+    timestamp = timestamp.astimezone(datetime.timezone.utc)
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return timestamp - ((timestamp - epoch) % window)
+
+
+def slice_range(dt_from, dt_to, window, slice_span):
+    # slices must hold a whole number of windows
+    span = max(window, (slice_span // window) * window)
+    boundaries = [dt_from]
+    boundary = align_to_window(dt_from, window) + span
+    while boundary < dt_to:
+        boundaries.append(boundary)
+        boundary += span
+    boundaries.append(dt_to)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def concat_frames(results, order_by=None):
+    frames = []
+    for result in results:
+        # query_data_frame returns a list when tables have differing schemas
+        if isinstance(result, list):
+            frames.extend(result)
+        else:
+            frames.append(result)
+    frames = [frame for frame in frames if not frame.empty]
+    if len(frames) == 0:
+        return DataFrame()
+
+    data_frame = concat(frames, ignore_index=True)
+    if order_by:
+        sort_columns = [column for column in order_by if column in data_frame]
+        if sort_columns:
+            data_frame = data_frame.sort_values(sort_columns, kind="stable", ignore_index=True)
+    return data_frame
+
+
 @lru_cache
 def get_period_regex():
     return re.compile(r"(?P<number>\d*)(?P<unit>\w*)")
@@ -0,0 +1,98 @@
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class QueryResultCache:
+    """LRU cache of closed aggregate windows for windowed influx queries.
+
+    Each entry holds the rows of one query shape (query text + parameters other
+    than the range) for the contiguous span of closed windows
+    ``[covered_from, covered_to)``. Total size is bounded by ``max_bytes`` as
+    reported by ``DataFrame.memory_usage(deep=True)``. An entry is dropped
+    ``max_age_seconds`` after it was first fetched, even while it's being extended,
+    so points that land late in closed windows (e.g. replayed from a write spool)
+    show up after at most that long.
+    """
+
+    inst = None
+
+    @classmethod
+    def get_inst(cls) -> "QueryResultCache":
+        if cls.inst is None:
+            cls.inst = cls()
+        return cls.inst
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_age_seconds=3600):
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.__entries = OrderedDict()
+        self.__total_bytes = 0
+
+        self.hits = 0  # served from cache without fetching the tail
+        self.partial_hits = 0  # served from cache plus a tail fetch
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def configure(self, influx_config):
+        self.max_bytes = int(influx_config.get("cache_max_bytes", self.max_bytes))
+        self.max_age_seconds = float(influx_config.get("cache_max_age_seconds", self.max_age_seconds))
+        self.__evict()
+
+    def get(self, key):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["fetched_at"] > self.max_age_seconds:
+            self.remove(key)
+            self.expired += 1
+            return None
+        self.__entries.move_to_end(key)
+        return entry
+
+    def put(self, key, data_frame, covered_from, covered_to, fetched_at=None):
+        """``fetched_at`` (time.monotonic) is when the oldest rows were fetched, now if not given"""
+        self.remove(key)
+        size = int(data_frame.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            logger.debug(f"Not caching query result of {size} bytes - larger than cache")
+            return
+        self.__entries[key] = {
+            "frame": data_frame,
+            "covered_from": covered_from,
+            "covered_to": covered_to,
+            "bytes": size,
+            "fetched_at": time.monotonic() if fetched_at is None else fetched_at,
+        }
+        self.__total_bytes += size
+        self.__evict()
+
+    def remove(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__total_bytes -= entry["bytes"]
+
+    def clear(self):
+        self.__entries = OrderedDict()
+        self.__total_bytes = 0
+
+    def __evict(self):
+        while self.__total_bytes > self.max_bytes and self.__entries:
+            _key, entry = self.__entries.popitem(last=False)
+            self.__total_bytes -= entry["bytes"]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "entries": len(self.__entries),
+            "bytes": self.__total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "partial_hits": self.partial_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
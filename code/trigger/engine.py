@@ -1,24 +1,63 @@
 from .scheduler import ScheduleTrigger
 from .http_request import HTTPTrigger
 from .mqtt_event import MQTTTrigger
+from .mqtt_event.mqtt_event import graceful_signal_handler
+from influx_pool import InfluxClientPool
+from query.result_cache import QueryResultCache
+from output.influx_writer import BackgroundWriter
+from output.kinabase import KBManager
+from output.kinabase_outbox import KinabaseOutbox
 
 import asyncio
+import logging
+import signal
+import pandas
+from config_manager import is_true
+
+logger = logging.getLogger(__name__)
 
 class TriggerEngine:
     def __init__(self, config):
         self.__scheduler = ScheduleTrigger(config)
         self.__http = HTTPTrigger(self.__scheduler, config)
         self.__mqtt = MQTTTrigger(config)
+        # lets pipeline branches share a frame until one of them writes to it (see branch_copy)
+        pandas.set_option("mode.copy_on_write", is_true(config.get("pandas_copy_on_write", True)))
+        InfluxClientPool.get_inst().configure(config.get("influx", {}))
+        QueryResultCache.get_inst().configure(config.get("influx", {}))
+        BackgroundWriter.get_inst().configure(config.get("influx", {}))
+        KBManager.configure(config.get("kinabase", {}))
+        KinabaseOutbox.get_inst().configure(config.get("kinabase", {}))
 
     def start(self):
         asyncio.run(self.main())
 
     async def main(self):
-        await asyncio.gather(
+        runs = asyncio.gather(
             self.__scheduler.run(),
             self.__http.run(),
             self.__mqtt.run(),
+            BackgroundWriter.get_inst().run(),
+            KinabaseOutbox.get_inst().run(),
         )
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.__terminate, sig, runs)
+        try:
+            await runs
+        except asyncio.CancelledError:
+            logger.info("Triggers stopped, closing outputs")
+        finally:
+            await BackgroundWriter.get_inst().close()
+            await InfluxClientPool.get_inst().close()
+            await KinabaseOutbox.get_inst().close()
+            await KBManager.close_all()
+
+    def __terminate(self, sig, runs):
+        # the scheduler and http loops never return, so they are cancelled to let the
+        # outputs above be closed (buffered influx writes spooled) before the alarm fires
+        graceful_signal_handler(sig, None)
+        runs.cancel()
 
     @property
     def http(self):
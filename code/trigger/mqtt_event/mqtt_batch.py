@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import pandas
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBatcher:
+    """Collects messages for a topic filter and passes them on as one DataFrame.
+
+    Registered as an ordinary topic handler by MQTTTrigger.batch. The batch is handed to
+    ``func(data_frame, config=config)`` once ``max_messages`` have arrived or ``max_delay``
+    seconds after the first message of the batch, whichever is first. Each payload becomes a
+    row (a list payload becomes one row per item, a non dict item a ``value`` column), plus a
+    ``topic`` column and a column for each wildcard level of the filter - named by
+    ``topic_columns`` or ``topic_<level>`` by default (``#`` gets the rest of the topic).
+    These topic columns take the place of any payload key with the same name.
+    """
+
+    def __init__(self, func, topic_filter, max_messages=1000, max_delay=1.0, topic_columns=None):
+        self.func = func
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self.__name__ = getattr(func, "__name__", repr(func))
+        self.__qualname__ = f"batch:{getattr(func, '__qualname__', self.__name__)}"
+
+        filter_tokens = topic_filter.split("/")
+        self.wildcards = [index for index, token in enumerate(filter_tokens) if token in ("+", "#")]
+        if topic_columns is None:
+            topic_columns = [f"topic_{index}" for index in self.wildcards]
+        if len(topic_columns) != len(self.wildcards):
+            raise Exception(
+                f"{len(topic_columns)} topic_columns given for {len(self.wildcards)} wildcard(s) in {topic_filter}"
+            )
+        if len(set(["topic", *topic_columns])) != len(topic_columns) + 1:
+            raise Exception(f"topic_columns {topic_columns} must be distinct and can't be 'topic'")
+        self.topic_columns = topic_columns
+        self.rest_index = len(filter_tokens) - 1 if filter_tokens[-1] == "#" else None
+
+        self.__topics = []
+        self.__payloads = []
+        self.__timer = None
+        self.__lock = asyncio.Lock()
+        self.__config = None
+
+    async def __call__(self, topic, payload, config=None):
+        self.__config = config
+        self.__topics.append(topic)
+        self.__payloads.append(payload)
+        if len(self.__payloads) >= self.max_messages:
+            await self.flush()
+        elif self.__timer is None:
+            self.__timer = asyncio.create_task(self.__flush_later())
+
+    async def __flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self.__timer = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception(f"MQTT batch handler {self.__name__} failed")
+
+    async def flush(self):
+        if self.__timer is not None and self.__timer is not asyncio.current_task():
+            self.__timer.cancel()
+            self.__timer = None
+        topics, payloads = self.__topics, self.__payloads
+        self.__topics, self.__payloads = [], []
+        if not payloads:
+            return
+        data_frame = self.to_data_frame(topics, payloads)
+        async with self.__lock:  # batches reach func in the order they were collected
+            await self.func(data_frame, config=self.__config)
+
+    def to_data_frame(self, topics, payloads):
+        rows = []
+        row_topics = []
+        for topic, payload in zip(topics, payloads):
+            items = payload if isinstance(payload, list) else [payload]
+            for item in items:
+                rows.append(item if isinstance(item, dict) else {"value": item})
+                row_topics.append(topic)
+
+        data_frame = pandas.DataFrame.from_records(rows)
+        # the columns taken from the topic replace payload keys of the same name
+        data_frame = data_frame.drop(
+            columns=[column for column in ["topic", *self.topic_columns] if column in data_frame.columns]
+        )
+        data_frame.insert(0, "topic", row_topics)
+
+        # split each distinct topic once and spread the tokens over its rows
+        codes, distinct = pandas.factorize(data_frame["topic"])
+        split = [topic.split("/") for topic in distinct]
+        for position, (index, column) in enumerate(zip(self.wildcards, self.topic_columns)):
+            if index == self.rest_index:
+                values = ["/".join(tokens[index:]) for tokens in split]
+            else:
+                values = [tokens[index] if index < len(tokens) else None for tokens in split]
+            data_frame.insert(1 + position, column, pandas.Series(values, dtype=object).to_numpy()[codes])
+        return data_frame
@@ -1,9 +1,9 @@
 import logging
 import asyncio
-from paho.mqtt.client import Client as MQTTClient, CallbackAPIVersion
-import json
+from paho.mqtt.client import Client as MQTTClient, CallbackAPIVersion, MQTT_ERR_SUCCESS
 import signal
 from .mqtt_handler import MQTTHandler
+from .mqtt_batch import MessageBatcher
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +21,12 @@ def graceful_signal_handler(sig, _frame):
 
 class MQTTTrigger:
     def __init__(self, config):
-        self.mqtt_handler = MQTTHandler()
+        self.mqtt_handler = MQTTHandler(
+            max_queued=config.get("mqtt_max_queued", 10000),
+            overflow=config.get("mqtt_overflow", "drop_oldest"),
+            max_concurrency=config.get("mqtt_max_concurrency", 8),
+            topic_cache_size=config.get("mqtt_topic_cache_size", 4096),
+        )
         self.config = config
 
         self.broker = config.get("input_broker", "mqtt.docker.local")
@@ -55,36 +60,49 @@ class MQTTTrigger:
                     timeout = self.limit
 
     async def run(self):
-        # Setup signal handlers for graceful termination
-        signal.signal(signal.SIGINT, graceful_signal_handler)
-        signal.signal(signal.SIGTERM, graceful_signal_handler)
-
+        # SIGINT/SIGTERM are handled by the TriggerEngine, which calls graceful_signal_handler
         mqttc = MQTTClient(CallbackAPIVersion.VERSION2)
         mqttc.on_connect = mqtt_on_connect
         mqttc.on_message = mqtt_on_message
         mqttc.on_disconnect = self.mqtt_on_disconnect
         mqttc.user_data_set(self.mqtt_handler)
+        helper = AsyncioSocketHelper(asyncio.get_running_loop(), mqttc)
+        self.mqtt_handler.set_flow_control(helper.pause_reading, helper.resume_reading)
 
         await self.mqtt_connect(mqttc, first_time=True)
 
+        dispatcher = asyncio.create_task(self.mqtt_handler.dispatch(self.config))
         try:
             while terminate_flag is False:
-                await asyncio.sleep(0.1)
-                rc = mqttc.loop(timeout=0.1)
-                if rc == 0:
-                    await self.mqtt_handler.call_functions_for_messages(self.config)
+                # messages are dispatched as they arrive, this only watches for termination
+                await asyncio.sleep(1)
 
         finally:
+            dispatcher.cancel()
             mqttc.disconnect()
             logger.info("MQTT connection closed")
 
-    def register_topic(self,topic,func):
-        self.mqtt_handler.register_function_to_topic(topic, func)
+    def register_topic(self,topic,func,decode="json"):
+        self.mqtt_handler.register_function_to_topic(topic, func, decode)
 
     # this is a decorator
-    def event(self,topic):
+    def event(self,topic,decode="json"):
+        """func(topic, payload, config=...) is called for each message on topic. ``decode`` is how
+        the payload bytes are decoded first: "json" (default), "text", "raw" (the bytes as
+        received) or a callable taking the bytes, e.g. ``float`` for a bare number"""
         def inner(func):
-            self.register_topic(topic,func)
+            self.register_topic(topic,func,decode)
+            return func
+        return inner
+
+    # this is a decorator
+    def batch(self, topic, max_messages=1000, max_delay=1.0, topic_columns=None, decode="json"):
+        """Like event but func(data_frame, config=...) receives the messages as one DataFrame,
+        see MessageBatcher"""
+        def inner(func):
+            self.register_topic(
+                topic, MessageBatcher(func, topic, max_messages, max_delay, topic_columns), decode
+            )
             return func
         return inner
 
@@ -96,6 +114,61 @@ class MQTTTrigger:
             asyncio.get_running_loop().create_task(self.mqtt_connect(client))
 
 
+class AsyncioSocketHelper:
+    """Drives the paho client from the asyncio event loop instead of polling it.
+
+    The socket is watched with add_reader (and add_writer while paho has data waiting to be
+    sent), so incoming messages are handled as soon as they arrive. loop_misc (keepalive
+    pings, timeouts) runs once a second while connected.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: MQTTClient):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.sock = None
+        self.paused = False
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.sock = sock
+        if not self.paused:
+            self.loop.add_reader(sock, client.loop_read)
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.sock = None
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def pause_reading(self):
+        # unread data stays in the socket buffer, so TCP flow control pushes back on the broker
+        self.paused = True
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+
+    def resume_reading(self):
+        self.paused = False
+        if self.sock is not None:
+            self.loop.add_reader(self.sock, self.client.loop_read)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
 def mqtt_on_connect(
     client: MQTTClient, handler: MQTTHandler, flags, reason_code, properties
 ):
@@ -107,5 +180,7 @@ def mqtt_on_connect(
 
 
 def mqtt_on_message(client: MQTTClient, handler: MQTTHandler, msg):
-    handler.add_msg(msg.topic,json.loads(msg.payload))
-    logger.debug(f"MQTT IN - topic: {msg.topic} payload: {msg.payload}")
+    # decoding is left to the handler, after the topic is matched and outside the network loop
+    handler.add_msg(msg.topic,msg.payload)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"MQTT IN - topic: {msg.topic} payload: {msg.payload}")
@@ -19,81 +19,252 @@
 # ----------------------------------------------------------------------
 
 
+import asyncio
 import logging
+import time
+from collections import deque
 
 logger = logging.getLogger(__name__)
-from .simple_tree import SimpleTreeNode
+from .topic_trie import TopicTrie
+from .payload import get_decoder
+
+OVERFLOW_POLICIES = ("drop_oldest", "conflate", "block")
+
+# stands in for the payload when it couldn't be decoded
+_UNDECODABLE = object()
 
 
 class MQTTHandler:
-    def __init__(self):
-        self.topic_map = SimpleTreeNode()
-        self.msg_queue = []
+    """Routes MQTT messages to the functions registered for their topic.
+
+    Messages wait in a queue per topic. Topics are handled concurrently, up to
+    ``max_concurrency`` at once, while messages on the same topic are handled one at a time
+    in the order they arrived. At most ``max_queued`` messages wait in total; when a message
+    arrives on a full queue the ``overflow`` policy decides what happens:
+
+    - drop_oldest: the oldest waiting message on the same topic is dropped (or, if that topic
+      has none waiting, on the topic that has waited longest)
+    - conflate: the newest waiting message on the same topic is replaced, so only the latest
+      value is handled (drop_oldest if none is waiting)
+    - block: the message is kept and reading from the broker is paused (see set_flow_control)
+      until the queue is down to half full
+
+    Payloads are queued as the raw bytes received and decoded when they are handled, once
+    per decoding the topic's functions were registered with (``decode``, JSON by default).
+    Messages on topics no function is registered for are neither queued nor decoded. A
+    payload that fails to decode is counted and skipped for the functions that needed that
+    decoding, the other functions still get the message.
+    """
+
+    # messages handled for a topic before it goes to the back of the line, so busy topics can't starve the rest
+    turn_size = 16
+
+    def __init__(self, max_queued=10000, overflow="drop_oldest", max_concurrency=8, topic_cache_size=4096):
+        self.topic_map = TopicTrie(cache_size=topic_cache_size)
         self.subscriptions = []
+        self.configure(max_queued=max_queued, overflow=overflow, max_concurrency=max_concurrency)
+
+        self.__queues = {}  # topic -> deque of waiting messages
+        self.__ready = deque()  # topics with waiting messages that aren't being handled, longest waiting first
+        self.__in_flight = set()
+        self.__tasks = set()
+        self.__msg_waiting = asyncio.Event()
+        self.__pause_reading = None
+        self.__resume_reading = None
+        self.__paused = False
+
+        self.depth = 0
+        self.max_depth = 0
+        self.received = 0
+        self.handled = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.pauses = 0
+        self.unmatched = 0
+        self.decode_errors = 0
+        self.last_decode_error = None
+        self.wait_s_total = 0.0
+        self.wait_s_max = 0.0
+        self.handler_stats = {}
+
+    def configure(self, max_queued=None, overflow=None, max_concurrency=None):
+        if overflow is not None and overflow not in OVERFLOW_POLICIES:
+            raise Exception(f"Unknown MQTT overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}")
+        if max_queued is not None:
+            self.max_queued = int(max_queued)
+        if overflow is not None:
+            self.overflow = overflow
+        if max_concurrency is not None:
+            self.max_concurrency = int(max_concurrency)
+
+    def set_flow_control(self, pause_reading, resume_reading):
+        """Callables used by the block overflow policy to stop and restart reading from the broker"""
+        self.__pause_reading = pause_reading
+        self.__resume_reading = resume_reading
 
-    def register_function_to_topic(self, topic, func):
+    def register_function_to_topic(self, topic, func, decode="json"):
         self.subscriptions.append(topic)
-        topic_tokens = topic.split("/")
-        return add_to_tree(topic_tokens, self.topic_map, func)
+        self.topic_map.add(topic, (func, get_decoder(decode)))
 
     def add_msg(self, topic, payload):
-        self.msg_queue.append({"topic": topic, "payload": payload})
+        """Queue a message, ``payload`` is the raw bytes received"""
+        self.received += 1
+        if not self.topic_map.match(topic):
+            self.unmatched += 1
+            return
+        queue = self.__queues.get(topic)
+        if queue is None:
+            queue = deque()
+            self.__queues[topic] = queue
+
+        if self.depth >= self.max_queued:
+            if self.overflow == "conflate" and queue:
+                queue[-1]["payload"] = payload
+                self.conflated += 1
+                return
+            if self.overflow == "block":
+                self.__pause()
+            else:
+                self.__drop_oldest(topic)
+
+        queue.append({"topic": topic, "payload": payload, "received": time.perf_counter()})
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        if len(queue) == 1 and topic not in self.__in_flight:
+            self.__ready.append(topic)
+        self.__msg_waiting.set()
+
+    def __drop_oldest(self, topic):
+        victim = topic if self.__queues[topic] else None
+        if victim is None:
+            victim = self.__ready[0] if self.__ready else next(
+                (other for other, queue in self.__queues.items() if queue), None
+            )
+        if victim is None:
+            return
+        queue = self.__queues[victim]
+        queue.popleft()
+        self.depth -= 1
+        self.dropped += 1
+        if not queue and victim in self.__ready:
+            self.__ready.remove(victim)
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning(f"MQTT message queue full ({self.max_queued}), {self.dropped} message(s) dropped so far")
+
+    def __pause(self):
+        if not self.__paused and self.__pause_reading is not None:
+            logger.warning(f"MQTT message queue full ({self.max_queued}), pausing reading from the broker")
+            self.__paused = True
+            self.pauses += 1
+            self.__pause_reading()
+
+    def __maybe_resume(self):
+        if self.__paused and self.depth <= self.max_queued // 2:
+            self.__paused = False
+            logger.info("Resuming reading from the MQTT broker")
+            self.__resume_reading()
 
     def get_functions_for_topic(self, topic):
-        topic_tokens = topic.split("/")
-        result = recursive_search(topic_tokens, self.topic_map)
-        return result
-
-    async def call_functions_for_messages(self,config):
-        for msg in self.msg_queue:
-            topic = msg["topic"]
-            payload = msg["payload"]
-            function_set = self.get_functions_for_topic(topic)
-            for func in function_set:
-                await func(topic, payload, config=config)
-        self.msg_queue = []
-        
+        return [func for func, _decoder in self.topic_map.match(topic)]
+
+    async def dispatch(self, config):
+        """Hand waiting messages to their topic's functions, runs until cancelled"""
+        slots = asyncio.Semaphore(self.max_concurrency)
+        try:
+            while True:
+                while not self.__ready:
+                    self.__msg_waiting.clear()
+                    await self.__msg_waiting.wait()
+                await slots.acquire()
+                if not self.__ready:  # everything waiting was dropped meanwhile
+                    slots.release()
+                    continue
+                topic = self.__ready.popleft()
+                self.__in_flight.add(topic)
+                task = asyncio.create_task(self.__handle_topic(topic, config, slots))
+                self.__tasks.add(task)
+                task.add_done_callback(self.__tasks.discard)
+        finally:
+            for task in list(self.__tasks):
+                task.cancel()
+
+    async def __handle_topic(self, topic, config, slots):
+        queue = self.__queues[topic]
+        try:
+            for _ in range(self.turn_size):
+                if not queue:
+                    break
+                msg = queue.popleft()
+                self.depth -= 1
+                self.__maybe_resume()
+                self.handled += 1
+                wait = time.perf_counter() - msg["received"]
+                self.wait_s_total += wait
+                self.wait_s_max = max(self.wait_s_max, wait)
+                decoded = {}
+                for func, decoder in self.topic_map.match(topic):
+                    if decoder not in decoded:
+                        decoded[decoder] = self.__decode(decoder, topic, msg["payload"])
+                    if decoded[decoder] is not _UNDECODABLE:
+                        await self.__call(func, topic, decoded[decoder], config)
+        finally:
+            self.__in_flight.discard(topic)
+            if queue:
+                self.__ready.append(topic)
+                self.__msg_waiting.set()
+            else:
+                self.__queues.pop(topic, None)
+            slots.release()
+
+    def __decode(self, decoder, topic, payload):
+        try:
+            return decoder(payload)
+        except Exception as e:
+            self.decode_errors += 1
+            self.last_decode_error = {"topic": topic, "error": f"{type(e).__name__}: {e}", "payload": payload[:200]}
+            if self.decode_errors == 1 or self.decode_errors % 1000 == 0:
+                logger.warning(
+                    f"Unable to decode MQTT payload on {topic} ({self.decode_errors} so far): {e} - payload: {payload[:200]!r}"
+                )
+            return _UNDECODABLE
+
+    async def __call(self, func, topic, payload, config):
+        name = getattr(func, "__qualname__", repr(func))
+        entry = self.handler_stats.get(name)
+        if entry is None:
+            entry = {"count": 0, "errors": 0, "seconds_total": 0.0, "seconds_max": 0.0}
+            self.handler_stats[name] = entry
+        start = time.perf_counter()
+        try:
+            await func(topic, payload, config=config)
+        except Exception:
+            entry["errors"] += 1
+            logger.exception(f"MQTT handler {name} failed for {topic}")
+        elapsed = time.perf_counter() - start
+        entry["count"] += 1
+        entry["seconds_total"] += elapsed
+        entry["seconds_max"] = max(entry["seconds_max"], elapsed)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "topics_in_flight": len(self.__in_flight),
+            "received": self.received,
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "conflated": self.conflated,
+            "pauses": self.pauses,
+            "unmatched": self.unmatched,
+            "decode_errors": self.decode_errors,
+            "last_decode_error": self.last_decode_error,
+            "wait_s_mean": self.wait_s_total / self.handled if self.handled else None,
+            "wait_s_max": self.wait_s_max,
+            "handlers": {
+                name: {**entry, "seconds_mean": entry["seconds_total"] / entry["count"] if entry["count"] else None}
+                for name, entry in self.handler_stats.items()
+            },
+        }
+
     def has_entries(self):
-        return self.topic_map.size() > 0
-
-
-def recursive_search(tokens, current_tree_level: SimpleTreeNode):
-    function_set = set()
-    if len(tokens) == 0:
-        # logger.debug(f"No more tokens, returning current node value {current_tree_level.getValue()}")
-        function_set.update(current_tree_level.getValue())
-        return function_set
-
-    token = tokens[0]
-
-    if token in current_tree_level:
-        # logger.debug(f">{token} at level")
-        function_subset = recursive_search(tokens[1:], current_tree_level[token])
-        if function_subset is not None:
-            function_set.update(function_subset)
-
-    if "+" in current_tree_level:
-        # logger.debug(f">'+' at level for {token}")
-        function_subset = recursive_search(tokens[1:], current_tree_level["+"])
-        if function_subset is not None:
-            function_set.update(function_subset)
-
-    if "#" in current_tree_level:
-        # logger.debug(f">'#' at level for {token}, returning {current_tree_level['#'].getValue()}")
-        function_set.update(current_tree_level["#"].getValue())
-
-    return function_set
-
-
-# build tree on add - uid is a function
-def add_to_tree(tokens, current_level: SimpleTreeNode, func):
-    token = tokens.pop(0)
-    if len(tokens) == 0 or token == "#":  # if no more tokens or wildcard
-        if token not in current_level:
-            current_level.createNode(token)
-        current_level[token].getValue().add(func)
-    else:
-        if token not in current_level:
-            current_level.createNode(token)
-        # recurse at next level down
-        add_to_tree(tokens, current_level[token], func)
+        return len(self.topic_map) > 0
@@ -0,0 +1,41 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def decode_json(payload):
+    """JSON payload to python, using orjson when it is installed.
+
+    Anything orjson rejects that the standard library accepts (NaN/Infinity, UTF-16/32
+    payloads) falls back to json.loads. The one difference is that orjson reads integers
+    over 64 bits as floats."""
+    if orjson is not None:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(payload)
+
+
+def decode_text(payload):
+    return payload.decode("utf-8")
+
+
+def decode_raw(payload):
+    return payload
+
+
+DECODERS = {"json": decode_json, "text": decode_text, "raw": decode_raw}
+
+
+def get_decoder(decode):
+    """Decoder for a handler's ``decode`` option - one of DECODERS by name, or a callable
+    that takes the payload bytes (e.g. ``float`` or a schema's parse function)"""
+    if callable(decode):
+        return decode
+    if decode not in DECODERS:
+        raise Exception(f"Unknown MQTT payload decoding {decode}, expected one of {tuple(DECODERS)} or a callable")
+    return DECODERS[decode]
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+
+
+class TopicNode:
+    __slots__ = ("children", "funcs")
+
+    def __init__(self):
+        self.children = {}
+        self.funcs = []
+
+
+class TopicTrie:
+    """Topic filters (with + and # wildcards) mapped to the functions registered for them.
+
+    Matching walks the trie iteratively and the result for each concrete topic is kept in an
+    LRU cache of up to ``cache_size`` topics, which is cleared whenever a function is added.
+    As before, a filter ending in # matches topics with at least one more level
+    ("a/#" matches "a/b" but not "a").
+    """
+
+    def __init__(self, cache_size=4096):
+        self.root = TopicNode()
+        self.cache_size = cache_size
+        self.__cache = OrderedDict()
+        self.__size = 0
+
+    def add(self, topic_filter, func):
+        node = self.root
+        for token in topic_filter.split("/"):
+            child = node.children.get(token)
+            if child is None:
+                child = TopicNode()
+                node.children[token] = child
+            node = child
+            if token == "#":  # matches everything below, later tokens are meaningless
+                break
+        if func not in node.funcs:
+            node.funcs.append(func)
+            self.__size += 1
+        self.__cache.clear()
+
+    def match(self, topic):
+        """Tuple of the functions whose filters match topic"""
+        cache = self.__cache
+        funcs = cache.get(topic)
+        if funcs is not None:
+            cache.move_to_end(topic)
+            return funcs
+
+        tokens = topic.split("/")
+        depth = len(tokens)
+        found = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, index = stack.pop()
+            if index == depth:
+                found.extend(node.funcs)
+                continue
+            children = node.children
+            if not children:
+                continue
+            wildcard = children.get("#")
+            if wildcard is not None:
+                found.extend(wildcard.funcs)
+            child = children.get(tokens[index])
+            if child is not None:
+                stack.append((child, index + 1))
+            single = children.get("+")
+            if single is not None:
+                stack.append((single, index + 1))
+
+        funcs = tuple(dict.fromkeys(found))  # a function registered under several matching filters runs once
+        cache[topic] = funcs
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return funcs
+
+    def __len__(self):
+        return self.__size
+
+    def cache_info(self):
+        return {"entries": len(self.__cache), "max_entries": self.cache_size}